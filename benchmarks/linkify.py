@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Compares the linkification of a newsletter rendered for many recipients:
+bleach.linkify() on each rendered email, and linkification of the template
+skeleton once with the values put back in.
+
+    python benchmarks/linkify.py [--recipients 2000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import bleach
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+settings.configure(
+    INSTALLED_APPS=[
+        'django.contrib.contenttypes',
+        'django.contrib.auth',
+        'massmailer',
+    ]
+)
+django.setup()
+
+from massmailer.models import Template, TemplateItem  # noqa: E402
+from massmailer.utils import linkify  # noqa: E402
+
+NEWSLETTER = """
+<h1>Our newsletter, {{ user.first_name }}!</h1>
+<p>Hello {{ user.first_name }} {{ user.last_name }},</p>
+<p>Registrations for the {{ event.name }} are open on www.example.org until
+{{ event.deadline }}. See https://example.org/events/ for all the details.</p>
+{% for article in articles %}
+<h2>{{ article.title }}</h2>
+<p>{{ article.summary }} Read more on https://example.org/blog/ or ask us at
+contact.example.org.</p>
+{% endfor %}
+<table>
+  <tr><td>Your school</td><td>{{ user.school }}</td></tr>
+  <tr><td>Your city</td><td>{{ user.city }}</td></tr>
+</table>
+<p>See you soon,<br>The team</p>
+<p><a href="https://example.org/account/{{ user.id }}">Your account</a></p>
+"""
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+    "eiusmod tempor incididunt ut labore et dolore magna aliqua. "
+)
+
+
+def contexts(count):
+    articles = [
+        {'title': 'Article {}'.format(i), 'summary': LOREM * 4}
+        for i in range(5)
+    ]
+    event = {'name': 'Summer camp', 'deadline': 'June 1st'}
+    for i in range(count):
+        user = {
+            'id': i,
+            'first_name': 'First{}'.format(i),
+            'last_name': 'Last{}'.format(i),
+            'school': 'School {}'.format(i % 40),
+            'city': 'City {}'.format(i % 7),
+        }
+        yield {'user': user, 'event': event, 'articles': articles}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--recipients', type=int, default=2000)
+    args = parser.parse_args()
+
+    template = Template(language='en', html_body=NEWSLETTER)
+    jinja_template = template.template(TemplateItem.html)
+
+    start = time.perf_counter()
+    before = [
+        bleach.linkify(jinja_template.render(context, language='en'))
+        for context in contexts(args.recipients)
+    ]
+    bleach_time = time.perf_counter() - start
+
+    linkify.SKELETONS.clear()
+    start = time.perf_counter()
+    after = [
+        template.render(TemplateItem.html, context)
+        for context in contexts(args.recipients)
+    ]
+    skeleton_time = time.perf_counter() - start
+
+    assert before == after, "the outputs differ"
+    for name, seconds in [
+        ('bleach.linkify per email', bleach_time),
+        ('linkified skeleton', skeleton_time),
+    ]:
+        print(
+            '{:<26} {:8.3f} ms/email'.format(
+                name, seconds / args.recipients * 1e3
+            )
+        )
+    print('speedup x{:.1f}'.format(bleach_time / skeleton_time))
+
+
+if __name__ == '__main__':
+    main()
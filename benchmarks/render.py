@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Measures the time to render a template with 20 attribute lookups and calls,
+in the different template environments.
+
+    python benchmarks/render.py [--renders 10000]
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+import django
+import jinja2.sandbox
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+settings.configure(
+    INSTALLED_APPS=[
+        'django.contrib.contenttypes',
+        'django.contrib.auth',
+        'massmailer',
+    ]
+)
+django.setup()
+
+from massmailer.utils.sandbox import SandboxedModelEnvironment  # noqa: E402
+
+
+class Profile:
+    school = 'École 42'
+    city = 'Paris'
+
+
+class User:
+    first_name = 'Ada'
+    last_name = 'Lovelace'
+    username = 'ada'
+    email = 'ada@example.org'
+    date_joined = datetime.date(1815, 12, 10)
+    profile = Profile()
+
+    def get_full_name(self):
+        return '{} {}'.format(self.first_name, self.last_name)
+
+    def delete(self):
+        pass
+
+    delete.alters_data = True
+
+
+SOURCE = '\n'.join(
+    [
+        "Dear {{ user.get_full_name() }} ({{ user.username }}),",
+        "{{ user.first_name }} {{ user.last_name }} <{{ user.email }}>",
+        "{{ user.profile.school }}, {{ user.profile.city }}",
+        "Joined on {{ user.date_joined.isoformat() }}.",
+    ]
+    * 2
+)
+
+ENVIRONMENTS = [
+    ('jinja2 sandbox', jinja2.sandbox.SandboxedEnvironment),
+    ('massmailer sandbox', SandboxedModelEnvironment),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--renders', type=int, default=10000)
+    args = parser.parse_args()
+
+    context = {'user': User()}
+    baseline = None
+    for name, environment_class in ENVIRONMENTS:
+        template = environment_class().from_string(SOURCE)
+        template.render(context)
+        seconds = min(
+            timeit.repeat(
+                lambda: template.render(context), number=args.renders, repeat=3
+            )
+        )
+        per_render = seconds / args.renders * 1e6
+        baseline = baseline or per_render
+        print(
+            '{:<20} {:8.1f} µs/render  x{:.2f}'.format(
+                name, per_render, baseline / per_render
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
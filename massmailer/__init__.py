@@ -1,4 +1,5 @@
 REGISTERED_ENUMS = {}
+REGISTERED_FILTERS = {}
 
 
 def register_enum(namespace, enum_name=None):
@@ -10,3 +11,17 @@ def register_enum(namespace, enum_name=None):
         return f
 
     return decorator
+
+
+def register_filter(filter_name=None, pure=False):
+    """
+    Makes a Jinja filter available in the templates. The results of pure
+    filters, that only depend on their arguments and on the template
+    language, may be reused for other recipients of a batch.
+    """
+
+    def decorator(f):
+        REGISTERED_FILTERS[filter_name or f.__name__] = (f, pure)
+        return f
+
+    return decorator
@@ -12,6 +12,7 @@ from django.utils.translation import get_language, ugettext_lazy as _
 from reversion.models import Version
 
 import massmailer.models
+from massmailer.utils.db import QueryTimeout
 
 
 class TemplateForm(forms.ModelForm):
@@ -93,7 +94,7 @@ class CreateBatchForm(forms.ModelForm):
 
     class Meta:
         model = massmailer.models.Batch
-        fields = ('name', 'template', 'query')
+        fields = ('name', 'template', 'query', 'render_at_send')
 
     @classmethod
     def foolproof_field(cls, count):
@@ -124,10 +125,9 @@ class CreateBatchForm(forms.ModelForm):
             and 'template' in self.data
         ):
             # once the form is submitted once, add the foolproof test (we now know the user count)
-            query = self.fields['query'].queryset.get(pk=self.data['query'])
-
-            result, user_qs = massmailer.models.Query.execute(query.query)
-            count = len(user_qs)
+            query = self.cleaned_data['query']
+            # counted by clean()
+            count = self.recipient_count
             submit = _("Actually send to %(n)s people right now") % {
                 'n': count
             }
@@ -139,7 +139,7 @@ class CreateBatchForm(forms.ModelForm):
                 disabled_copy = copy.deepcopy(f)  # add a disabled copy
                 disabled_copy.disabled = True
                 self.fields[name] = disabled_copy
-                self.initial[name] = self.data[field]  # copy value
+                self.initial[name] = self.data.get(field)  # copy value
                 f.widget = forms.HiddenInput()  # hide original data
 
             if not self.data.get('name'):
@@ -173,14 +173,23 @@ class CreateBatchForm(forms.ModelForm):
 
     def clean(self):
         query = self.cleaned_data['query']
-        result, qs = massmailer.models.Query.execute(query.query)
+        result, qs = massmailer.models.Query.execute(
+            query.query, check_exists=False
+        )
         template = self.cleaned_data['template']
-        if len(qs) == 0:
+        try:
+            self.recipient_count = massmailer.models.Query.count(
+                query.query, qs, sandboxed=True
+            )
+        except QueryTimeout as e:
+            raise forms.ValidationError(
+                _("The query was cancelled after %(timeout)s seconds."),
+                params={'timeout': e.timeout},
+            )
+        if self.recipient_count == 0:
             raise forms.ValidationError(_('The queryset must be non empty.'))
-        if (
-            len(qs) > 0
-            and template.is_marketing
-            and not hasattr(qs[0], 'get_unsubscribe_url')
+        if template.is_marketing and not hasattr(
+            qs.model, 'get_unsubscribe_url'
         ):
             raise forms.ValidationError(
                 _(
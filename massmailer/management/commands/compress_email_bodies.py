@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Length
+
+from massmailer.models import BatchEmail, BatchEmailContent
+from massmailer.utils.db import COMPRESSED_MARKER
+
+
+class Command(BaseCommand):
+    help = (
+        "Compresses the e-mail bodies that were stored before compression "
+        "was enabled."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help="Number of rows updated per transaction.",
+        )
+
+    def handle(self, *args, batch_size, **options):
+        fields = [
+            (BatchEmail, 'body_text'),
+            (BatchEmail, 'html_body_text'),
+            (BatchEmailContent, 'content'),
+        ]
+        for model, field in fields:
+            count = self.compress(model, field, batch_size)
+            self.stdout.write(
+                "Compressed {} {}.{}.".format(count, model.__name__, field)
+            )
+
+    def compress(self, model, field, batch_size):
+        min_length = model._meta.get_field(field).min_length
+        rows = (
+            model.objects.annotate(massmailer_length=Length(field))
+            .filter(massmailer_length__gte=min_length)
+            .exclude(**{field + '__startswith': COMPRESSED_MARKER})
+            .order_by('pk')
+        )
+        count = 0
+        last_pk = None
+        while True:
+            page = rows
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+            # values are read uncompressed and written back compressed
+            objs = [
+                model(**{'pk': pk, field: value})
+                for pk, value in page.values_list('pk', field)[:batch_size]
+            ]
+            if not objs:
+                return count
+            with transaction.atomic():
+                model.objects.bulk_update(objs, [field])
+            count += len(objs)
+            last_pk = objs[-1].pk
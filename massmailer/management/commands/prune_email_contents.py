@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from massmailer.models import BatchEmailContent
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the stored e-mail contents that are no longer used by any "
+        "e-mail."
+    )
+
+    def handle(self, *args, **options):
+        deleted = BatchEmailContent.objects.prune()
+        if deleted is None:
+            self.stdout.write(
+                "Batches are being built, try again once they are ready."
+            )
+        else:
+            self.stdout.write("Deleted {} e-mail contents.".format(deleted))
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-16 21:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [('massmailer', '0002_mail_general_model')]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='build_progress',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='build_state',
+            field=models.PositiveIntegerField(default=2),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='build_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-16 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [('massmailer', '0003_batch_build_state')]
+
+    operations = [
+        migrations.AddField(
+            model_name='batch',
+            name='render_at_send',
+            field=models.BooleanField(
+                default=False,
+                help_text='Only stores the recipients when creating the batch, and renders each e-mail just before sending it.',
+                verbose_name='Render e-mails at send time',
+            ),
+        ),
+        migrations.AddField(
+            model_name='batch',
+            name='snapshot',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='batchemail',
+            name='object_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
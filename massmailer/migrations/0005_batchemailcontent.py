@@ -0,0 +1,92 @@
+# Generated by Django 2.2.28 on 2026-10-17 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [('massmailer', '0004_batch_render_at_send')]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchEmailContent',
+            fields=[
+                (
+                    'hash',
+                    models.CharField(
+                        max_length=64, primary_key=True, serialize=False
+                    ),
+                ),
+                ('content', models.TextField()),
+            ],
+        ),
+        # The rendered contents keep their columns, only the fields are
+        # renamed so that the properties can take their names.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='batchemail',
+                    old_name='subject',
+                    new_name='subject_text',
+                ),
+                migrations.RenameField(
+                    model_name='batchemail',
+                    old_name='body',
+                    new_name='body_text',
+                ),
+                migrations.RenameField(
+                    model_name='batchemail',
+                    old_name='html_body',
+                    new_name='html_body_text',
+                ),
+                migrations.AlterField(
+                    model_name='batchemail',
+                    name='subject_text',
+                    field=models.TextField(blank=True, db_column='subject'),
+                ),
+                migrations.AlterField(
+                    model_name='batchemail',
+                    name='body_text',
+                    field=models.TextField(blank=True, db_column='body'),
+                ),
+                migrations.AlterField(
+                    model_name='batchemail',
+                    name='html_body_text',
+                    field=models.TextField(
+                        blank=True, db_column='html_body', default=''
+                    ),
+                ),
+            ]
+        ),
+        migrations.AddField(
+            model_name='batchemail',
+            name='subject_content',
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name='+',
+                to='massmailer.BatchEmailContent',
+            ),
+        ),
+        migrations.AddField(
+            model_name='batchemail',
+            name='body_content',
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name='+',
+                to='massmailer.BatchEmailContent',
+            ),
+        ),
+        migrations.AddField(
+            model_name='batchemail',
+            name='html_body_content',
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name='+',
+                to='massmailer.BatchEmailContent',
+            ),
+        ),
+    ]
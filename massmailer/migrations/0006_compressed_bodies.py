@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-16 21:18
+
+from django.db import migrations
+import massmailer.utils.db
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [('massmailer', '0005_batchemailcontent')]
+
+    operations = [
+        migrations.AlterField(
+            model_name='batchemail',
+            name='body_text',
+            field=massmailer.utils.db.CompressedTextField(
+                blank=True, db_column='body'
+            ),
+        ),
+        migrations.AlterField(
+            model_name='batchemail',
+            name='html_body_text',
+            field=massmailer.utils.db.CompressedTextField(
+                blank=True, db_column='html_body', default=''
+            ),
+        ),
+        migrations.AlterField(
+            model_name='batchemailcontent',
+            name='content',
+            field=massmailer.utils.db.CompressedTextField(),
+        ),
+    ]
@@ -1,27 +1,50 @@
 import bleach
+import collections
 import enum
+import hashlib
 import jinja2
 import jinja2.meta
 import jinja2.runtime
+import json
 import operator
 import re
 import uuid
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.cache import caches
 from django.core.exceptions import FieldDoesNotExist
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.urls import reverse
-from django.db import models
+from django.db import connections, models, transaction
 from django.db.models import Count, F, BooleanField
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 from functools import reduce
 
-from massmailer.query_parser import QueryParser, ParseError
-from massmailer.utils import get_attr_rec, get_field_rec, filters as mfilters
-from massmailer.utils.db import ConditionalSum, CaseMapping
+from massmailer import REGISTERED_FILTERS
+from massmailer.query_parser import QueryParser, ParseError, normalize
+from massmailer.utils import (
+    chunked,
+    get_field_rec,
+    filters as mfilters,
+)
+from massmailer.utils import bytecode, linkify, planner, substitution
+from massmailer.utils.aliases import Aliases
+from massmailer.utils.cache import LRUCache
+from massmailer.utils.db import (
+    QUERY_TIMEOUT,
+    CaseMapping,
+    CompressedTextField,
+    ConditionalSum,
+    QueryTimeout,
+    sandboxed_queries,
+)
 from massmailer.utils.sandbox import SandboxedModelEnvironment
 
 TEMPLATE_OPTS = {
@@ -30,11 +53,69 @@ TEMPLATE_OPTS = {
     'undefined': jinja2.runtime.StrictUndefined,
 }
 
+BYTECODE_VERSION = 2
+
 VARIABLE_PLACEHOLDER = '<span class="placeholder">\u25cc</span>'
 RE_TAG = re.compile(
     r'\{([%#])(.*?)\1\}|\{\{(.*?)\}\}', re.MULTILINE | re.DOTALL
 )
 
+# Process-wide cache of compiled templates, keyed on (template pk,
+# TemplateItem, source, environment). Python caches the hash of the source
+# string, and key equality rules out collisions between two revisions of a
+# template, or between environments (eg. once filters are registered).
+COMPILED_TEMPLATES = LRUCache(
+    maxsize=getattr(settings, 'MASSMAILER_TEMPLATE_CACHE_SIZE', 256)
+)
+
+# Number of recipients fetched, rendered and saved at once when building a
+# batch, and number of rows per INSERT query.
+BUILD_CHUNK_SIZE = getattr(settings, 'MASSMAILER_BUILD_CHUNK_SIZE', 2000)
+FILTER_MEMO_SIZE = getattr(settings, 'MASSMAILER_FILTER_MEMO_SIZE', 1024)
+BULK_CREATE_BATCH_SIZE = getattr(
+    settings, 'MASSMAILER_BULK_CREATE_BATCH_SIZE', 500
+)
+# Number of recipients built by each Celery task of a batch.
+BUILD_PARTITION_SIZE = getattr(
+    settings, 'MASSMAILER_BUILD_PARTITION_SIZE', 20000
+)
+
+# Cache of the numbers of users targeted by queries, and how long (in
+# seconds) they are trusted for.
+COUNT_CACHE = getattr(settings, 'MASSMAILER_COUNT_CACHE', 'default')
+COUNT_CACHE_TIMEOUT = getattr(settings, 'MASSMAILER_COUNT_CACHE_TIMEOUT', 60)
+COUNTED = ('users', 'recipients')
+# Maximum duration (in seconds) of the exact counts made in the background
+# for the query editor, None for no limit. They are started by editing, so
+# they are limited too, less than the queries of the editor itself.
+COUNT_TIMEOUT = getattr(
+    settings, 'MASSMAILER_COUNT_TIMEOUT', QUERY_TIMEOUT and 6 * QUERY_TIMEOUT
+)
+
+# Template fields frozen in batches rendered at send time.
+FROZEN_TEMPLATE_FIELDS = [
+    'is_marketing',
+    'subject',
+    'plain_body',
+    'html_body',
+    'language',
+]
+
+# Long-lived environments, one per distinct set of template options, so that
+# Jinja's internal caches are reused across renders.
+ENVIRONMENTS = {}
+
+
+@receiver(setting_changed)
+def reset_environments(setting, **kwargs):
+    """
+    Environments keep the bytecode cache they were created with, and the
+    compiled templates their environment.
+    """
+    if setting == 'MASSMAILER_BYTECODE_CACHE':
+        ENVIRONMENTS.clear()
+        COMPILED_TEMPLATES.clear()
+
 
 class MailState(enum.IntEnum):
     pending = 1
@@ -49,10 +130,67 @@ class MailState(enum.IntEnum):
         return {cls.bounced, cls.complained}
 
 
+class BuildState(enum.IntEnum):
+    building = 1
+    ready = 2
+    failed = 3
+
+
 class TemplateItem(enum.Enum):
     subject = ('subject', {})
     plain = ('plain_body', {})
-    html = ('html_body', {'autoescape': True})
+    html = ('html_body', {'autoescape': True, 'finalize': linkify.finalize})
+
+
+class CompiledTemplate:
+    """
+    The parsed and compiled forms of a template source, each computed on
+    first use and shared by the previews, the introspection and the
+    rendering.
+    """
+
+    def __init__(self, env, source, name=None):
+        self.env = env
+        self.source = source
+        # name in the bytecode cache, if any
+        self.name = name
+
+    @cached_property
+    def ast(self):
+        return self.env.parse(self.source)
+
+    @cached_property
+    def variables(self):
+        return jinja2.meta.find_undeclared_variables(self.ast)
+
+    @cached_property
+    def template(self):
+        if self.name is None:
+            return self.env.from_string(self.ast)
+        return bytecode.compile_template(
+            self.env, self.source, self.name, parse=lambda: self.ast
+        )
+
+    @cached_property
+    def renderer(self):
+        """
+        The fast substitution renderer if the source only substitutes
+        variables, else the compiled template.
+        """
+        fast = substitution.compile_substitutions(self.env, self.ast)
+        return fast if fast is not None else self.template
+
+    @cached_property
+    def placeholders(self):
+        """Whether linkify.placeholders() can be used to render it."""
+        return linkify.supports(self.ast)
+
+    @cached_property
+    def preview(self):
+        def replace(match):
+            return jinja2.Markup(VARIABLE_PLACEHOLDER)
+
+        return RE_TAG.sub(replace, self.source)
 
 
 class Template(models.Model):
@@ -80,6 +218,38 @@ class Template(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        previous = None
+        if self.pk is not None and bytecode.get_cache() is not None:
+            previous = Template.objects.filter(pk=self.pk).first()
+        super().save(*args, **kwargs)
+        self.evict_compiled()
+        if previous is not None:
+            previous.prune_bytecode(changed_in=self)
+
+    def evict_compiled(self):
+        COMPILED_TEMPLATES.evict(lambda key: key[0] == self.pk)
+
+    def prune_bytecode(self, changed_in=None):
+        """
+        Removes the sources of this template from the bytecode cache, or only
+        those that differ in the `changed_in` revision.
+        """
+        for item in TemplateItem:
+            source = self.template_source(item)
+            if changed_in and changed_in.template_source(item) == source:
+                continue
+            bytecode.prune(
+                self.environment(item), self.bytecode_name(item, source)
+            )
+
+    @staticmethod
+    def bytecode_name(item: TemplateItem, source):
+        # the version changes when the compiled code of a source does
+        return bytecode.template_name(
+            'massmailer/{}/{}'.format(BYTECODE_VERSION, item.name), source
+        )
+
     @staticmethod
     def template_opts(item: TemplateItem):
         _, specific_opts = item.value
@@ -95,36 +265,71 @@ class Template(models.Model):
         attr, _ = item.value
         return getattr(self, attr)
 
-    def environment(self, item):
-        env = SandboxedModelEnvironment(**self.template_opts(item))
-        env.filters['format_datetime'] = mfilters.format_datetime
-        env.filters['format_date'] = mfilters.format_date
-        env.filters['format_time'] = mfilters.format_time
-        return env
+    @classmethod
+    def environment(cls, item: TemplateItem):
+        opts = cls.template_opts(item)
+        # filters registered later get their own environment
+        key = (
+            tuple(sorted(opts.items())),
+            tuple(REGISTERED_FILTERS.items()),
+        )
+        try:
+            return ENVIRONMENTS[key]
+        except KeyError:
+            pass
+        env = SandboxedModelEnvironment(
+            bytecode_cache=bytecode.get_cache(), **opts
+        )
+        env.filters.update(mfilters.template_filters())
+        # Two threads may build the same environment: only one is kept.
+        return ENVIRONMENTS.setdefault(key, env)
 
-    def template(self, item: TemplateItem):
+    def compiled(self, item: TemplateItem):
+        source = self.template_source(item)
         env = self.environment(item)
-        return env.from_string(source=self.template_source(item))
+
+        def build():
+            name = None
+            # Unsaved previews would only pollute the bytecode cache.
+            if self.pk is not None:
+                name = self.bytecode_name(item, source)
+            return CompiledTemplate(env, source, name)
+
+        return COMPILED_TEMPLATES.get_or_set(
+            (self.pk, item, source, env), build
+        )
+
+    def template(self, item: TemplateItem):
+        return self.compiled(item).template
+
+    def parse(self, item: TemplateItem):
+        return self.compiled(item).ast
 
     def variables(self, item: TemplateItem):
-        env = self.environment(item)
-        ast = env.parse(source=self.template_source(item))
-        return jinja2.meta.find_undeclared_variables(ast)
+        return self.compiled(item).variables
+
+    def rendered_items(self):
+        items = [TemplateItem.subject, TemplateItem.plain]
+        if self.html_enabled:
+            items.append(TemplateItem.html)
+        return items
 
     def render(self, item: TemplateItem, context: dict):
         context['language'] = self.language
-        content = self.template(item).render(context)
-        if item is TemplateItem.html:
-            content = bleach.linkify(content)
-        return content
+        compiled = self.compiled(item)
+        renderer = compiled.renderer
+        if item is not TemplateItem.html:
+            return renderer.render(context)
+        if compiled.placeholders:
+            with linkify.placeholders() as values:
+                skeleton = renderer.render(context)
+            content = linkify.linkify(skeleton, values)
+            if content is not None:
+                return content
+        return bleach.linkify(renderer.render(context))
 
     def preview(self, item: TemplateItem):
-        text = self.template_source(item)
-
-        def replace(match):
-            return jinja2.Markup(VARIABLE_PLACEHOLDER)
-
-        return RE_TAG.sub(replace, text)
+        return self.compiled(item).preview
 
     def full_preview(self, context):
         result = {}
@@ -142,6 +347,8 @@ class Template(models.Model):
                 data['error'] = {'type': 'undefined', 'msg': error.message}
             except jinja2.TemplateSyntaxError as error:
                 data['error'] = {'type': 'syntax', 'msg': error.message}
+            except QueryTimeout:
+                raise
             except Exception as error:
                 data['error'] = {'type': 'other', 'msg': str(error)}
             result[item.name] = data
@@ -188,6 +395,10 @@ class Query(models.Model):
             kwargs={'id': self.pk, 'slug': slugify(self.name)},
         )
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.forget_count(self.query)
+
     def get_results(self):
         return self.execute(self.query)
 
@@ -195,16 +406,23 @@ class Query(models.Model):
         return QueryParser().parse_query(self.query)
 
     @staticmethod
-    def execute(query):
+    def execute(query, check_exists=True):
+        """
+        Parses and checks `query`. Returns its parse result and the queryset
+        of the users it targets, without fetching the recipients. Callers
+        that count the recipients anyway can skip the check that there are
+        some with `check_exists=False`.
+        """
         result = QueryParser().parse_query(query)
         qs = result.queryset
-        if len(qs) <= 0:
+        if check_exists and not qs.exists():
             raise ParseError(_("The query must be non empty."))
 
         user_qs = qs
         User = get_user_model()
         if user_qs.model != User and 'user' in result.aliases:
             user_field = result.aliases['user']
+            qs_label = qs.model._meta.label
             try:
                 if get_field_rec(qs.model, user_field) != User:
                     raise ParseError(
@@ -212,29 +430,75 @@ class Query(models.Model):
                         % {
                             'label': qs_label,
                             'field': user_field,
-                            'model': user_label,
+                            'model': User._meta.label,
                         }
                     )
             except FieldDoesNotExist:
+                raise ParseError(
+                    _("%(label)s has no field `%(field)s`")
+                    % {'label': qs_label, 'field': user_field}
+                )
+            user_qs = User._default_manager.filter(
+                pk__in=qs.values(user_field)
+            )
+
+        if 'email' not in result.aliases:
+            if not hasattr(user_qs.model, 'email'):
                 raise ParseError(
                     _(
-                        "%(label)s has no field `%(field)s`"
-                        % {'label': qs_label, 'field': user_field}
+                        "The query must have an email field or declare an `email` alias."
                     )
                 )
-            user_pks = set(qs.values_list(user_field, flat=True))
-            user_qs = User._default_manager.filter(pk__in=user_pks)
-
-        if 'email' not in result.aliases and hasattr(user_qs[0], 'email'):
             result.aliases['email'] = 'email'
-        if 'email' not in result.aliases and not hasattr(user_qs[0], 'email'):
-            raise ParseError(
-                _(
-                    "The query must have an email field or declare an `email` alias."
-                )
-            )
         return result, user_qs
 
+    @staticmethod
+    def count_key(query, counted):
+        digest = hashlib.sha256(normalize(query).encode()).hexdigest()
+        return 'massmailer-query-count-{}-{}'.format(counted, digest)
+
+    @classmethod
+    def cached_count(cls, query, counted='users'):
+        """Returns the cached `counted` count of `query`, or None."""
+        return caches[COUNT_CACHE].get(cls.count_key(query, counted))
+
+    @classmethod
+    def cache_count(cls, query, counted, count):
+        caches[COUNT_CACHE].set(
+            cls.count_key(query, counted), count, COUNT_CACHE_TIMEOUT
+        )
+
+    @classmethod
+    def count(
+        cls,
+        query,
+        queryset,
+        counted='users',
+        sandboxed=False,
+        timeout=QUERY_TIMEOUT,
+    ):
+        """
+        Returns the number of rows of `queryset`, the `counted` queryset of
+        `query` (its 'users' or its 'recipients'), counted at most
+        MASSMAILER_COUNT_CACHE_TIMEOUT seconds ago. With `sandboxed`, they
+        are counted within sandboxed_queries(timeout).
+        """
+        count = cls.cached_count(query, counted)
+        if count is None:
+            if sandboxed:
+                with sandboxed_queries(timeout):
+                    count = queryset.count()
+            else:
+                count = queryset.count()
+            cls.cache_count(query, counted, count)
+        return count
+
+    @classmethod
+    def forget_count(cls, query):
+        caches[COUNT_CACHE].delete_many(
+            [cls.count_key(query, counted) for counted in COUNTED]
+        )
+
 
 class BatchManager(models.Manager):
     def get_queryset(self):
@@ -245,7 +509,6 @@ class BatchManager(models.Manager):
             super()
             .get_queryset()
             .select_related('query', 'template', 'initiator')
-            .prefetch_related('emails')
         )
 
         def annotate(key, value):
@@ -308,6 +571,19 @@ class Batch(models.Model):
         related_name='massmailer_batches',
     )
     date_created = models.DateTimeField(default=timezone.now, null=False)
+    build_state = models.PositiveIntegerField(default=BuildState.ready.value)
+    build_progress = models.PositiveIntegerField(default=0)
+    build_total = models.PositiveIntegerField(default=0)
+    render_at_send = models.BooleanField(
+        default=False,
+        verbose_name=_("Render e-mails at send time"),
+        help_text=_(
+            "Only stores the recipients when creating the batch, and renders "
+            "each e-mail just before sending it."
+        ),
+    )
+    # frozen template and query model, to render at send time
+    snapshot = models.TextField(blank=True, editable=False)
 
     class Meta:
         ordering = ['-date_created']
@@ -323,6 +599,24 @@ class Batch(models.Model):
     def __str__(self):
         return self.name or self.default_name
 
+    @property
+    def build_state_display(self):
+        return BuildState(self.build_state).name
+
+    @property
+    def building(self):
+        return self.build_state == BuildState.building.value
+
+    @property
+    def build_failed(self):
+        return self.build_state == BuildState.failed.value
+
+    @property
+    def build_percentage(self):
+        if not self.build_total:
+            return 100.0
+        return 100.0 * self.build_progress / self.build_total
+
     def pending_emails(self):
         return self.emails.filter(state=MailState.pending.value)
 
@@ -332,41 +626,300 @@ class Batch(models.Model):
             state__in=[state.value for state in MailState.bad()]
         )
 
-    def build_emails(self):
-        result, qs = self.query.get_results()
+    def recipients(self, pk_range=None, pks=None):
+        """
+        Returns the parse result of the query and its queryset ordered by
+        primary key, optionally restricted to the (first pk, last pk) range
+        or to a list of primary keys.
+        """
+        # an empty query builds an empty batch instead of failing it
+        result, qs = self.query.execute(self.query.query, check_exists=False)
         queryset = result.queryset.order_by('pk')
+        if pk_range is not None:
+            first_pk, last_pk = pk_range
+            queryset = queryset.filter(pk__gte=first_pk, pk__lte=last_pk)
+        if pks is not None:
+            queryset = queryset.filter(pk__in=pks)
+        return result, queryset
+
+    def recipient_pks(self, pk_range=None):
+        result, queryset = self.recipients(pk_range)
+        return queryset.values_list('pk', flat=True)
+
+    def partitions(self, size=None):
+        """
+        Splits the recipients of this batch in consecutive primary key ranges
+        of `size` recipients. Yields (first pk, last pk, count) tuples.
+        """
+        size = size or BUILD_PARTITION_SIZE
+        pks = self.recipient_pks().iterator(size)
+        for chunk in chunked(pks, size):
+            yield chunk[0], chunk[-1], len(chunk)
+
+    def freeze(self):
+        """
+        Stores the current revision of the template, and the model and
+        aliases of the query, to render the emails at send time.
+        """
+        result, qs = self.query.get_results()
+        template = {
+            field: getattr(self.template, field)
+            for field in FROZEN_TEMPLATE_FIELDS
+        }
+        self.snapshot = json.dumps(
+            {
+                'template': template,
+                'model': result.queryset.model._meta.label,
+                'model_name': result.model_name,
+                'aliases': result.aliases,
+            }
+        )
 
-        html_enabled = self.template.html_enabled
+    def frozen_template(self):
+        template = json.loads(self.snapshot)['template']
+        # the pk of the source template lets the compiled code be cached
+        return Template(pk=self.template_id, **template)
+
+    def frozen_query(self):
+        """Returns the (model, model name, aliases) frozen in the batch."""
+        snapshot = json.loads(self.snapshot)
+        model = apps.get_model(snapshot['model'])
+        return model, snapshot['model_name'], snapshot['aliases']
+
+    def render_email(self, template, model_name, aliases, object):
+        """
+        Renders the email of the recipient `object`, fetched from a queryset
+        annotated by `aliases`. Returns a dict of BatchEmail fields.
+        """
+        context = aliases.context(object)
+        context[model_name] = object
+
+        unsubscribe_url = ""
+        if template.is_marketing and hasattr(object, 'get_unsubscribe_url'):
+            unsubscribe_url = '<{}>'.format(
+                getattr(object, 'get_unsubscribe_url')
+            )
 
-        for object in queryset:
-            context = {
-                alias: get_attr_rec(object, field)
-                for alias, field in result.aliases.items()
-            }
-            context[result.model_name] = object
-            email = getattr(object, result.aliases['email'])
+        return {
+            'to': context['email'],
+            'unsubscribe_url': unsubscribe_url,
+            'subject': template.render(TemplateItem.subject, context),
+            'body': template.render(TemplateItem.plain, context),
+            'html_body': template.render(TemplateItem.html, context)
+            if template.html_enabled
+            else "",
+        }
 
-            unsubscribe_url = ""
-            if self.template.is_marketing and hasattr(
-                object, 'get_unsubscribe_url'
-            ):
-                unsubscribe_url = '<{}>'.format(
-                    getattr(object, 'get_unsubscribe_url')
+    def build_emails(self, chunk_size=None, pk_range=None, pks=None):
+        """
+        Yields the unsaved emails of this batch, optionally restricted to some
+        recipients (see recipients()). Recipients are streamed from the
+        database by chunks of `chunk_size`.
+
+        If the batch is rendered at send time, the emails only reference
+        their recipient.
+        """
+        chunk_size = chunk_size or BUILD_CHUNK_SIZE
+        result, queryset = self.recipients(pk_range, pks)
+
+        if self.render_at_send:
+            aliases = Aliases(
+                queryset.model, {'email': result.aliases['email']}
+            )
+            plan = self.plan(aliases)
+            queryset = aliases.annotate(plan.apply(queryset))
+            for object in queryset.iterator(chunk_size):
+                yield BatchEmail(
+                    batch=self,
+                    to=aliases.value(object, 'email'),
+                    object_id=str(object.pk),
                 )
+            return
+
+        aliases = Aliases(queryset.model, result.aliases)
+        plan = self.plan(aliases, result.model_name, self.template)
+        queryset = aliases.annotate(plan.apply(queryset))
+        # results of pure filters shared by the recipients of this build
+        memo = LRUCache(maxsize=FILTER_MEMO_SIZE) if FILTER_MEMO_SIZE else None
+        for chunk in chunked(queryset.iterator(chunk_size), chunk_size):
+            plan.prefetch(chunk)
+            # the memo is not left active while the emails are consumed
+            with mfilters.memoize(memo):
+                emails = [
+                    BatchEmail(
+                        batch=self,
+                        **self.render_email(
+                            self.template, result.model_name, aliases, object
+                        )
+                    )
+                    for object in chunk
+                ]
+            yield from emails
 
-            yield BatchEmail(
-                batch=self,
-                to=email,
-                unsubscribe_url=unsubscribe_url,
-                subject=self.template.render(TemplateItem.subject, context),
-                body=self.template.render(TemplateItem.plain, context),
-                html_body=self.template.render(TemplateItem.html, context)
-                if html_enabled
-                else "",
+    @staticmethod
+    def plan(aliases, model_name=None, template=None):
+        """
+        Plans the relations of the recipients to fetch along with them, to
+        evaluate `aliases` and render `template`. Aliases selected in SQL
+        need no relation.
+        """
+        roots = {alias: field.split('__') for alias, field in aliases.walked()}
+        templates = []
+        if template is not None:
+            roots[model_name] = []
+            templates = [
+                template.parse(item) for item in template.rendered_items()
+            ]
+        return planner.plan(aliases.model, roots, templates)
+
+    def create_emails(
+        self, chunk_size=None, batch_size=None, pk_range=None, count=None
+    ):
+        """
+        Builds and saves the emails of this batch, one transaction per chunk
+        of `chunk_size` recipients, so that memory usage is bounded by the
+        chunk size. Yields the lists of saved emails, in primary key order.
+
+        If a render executor is configured and there are at least
+        MASSMAILER_PARALLEL_RENDER_THRESHOLD recipients (`count`, when
+        known), chunks are rendered in parallel.
+        """
+        from massmailer import render
+
+        chunk_size = chunk_size or BUILD_CHUNK_SIZE
+        executor = None
+        if render.executor_class() is not None:
+            if count is None:
+                count = self.recipient_pks(pk_range).count()
+            if count >= render.parallel_threshold():
+                executor = render.get_executor()
+
+        if executor is None:
+            built = self.build_emails(chunk_size, pk_range)
+            chunks = chunked(built, chunk_size)
+        else:
+            chunks = render.render_parallel(
+                self, executor, chunk_size, pk_range
             )
+        try:
+            for emails in chunks:
+                with transaction.atomic():
+                    BatchEmail.store_contents(emails)
+                    BatchEmail.objects.bulk_create(
+                        emails,
+                        batch_size=batch_size or BULK_CREATE_BATCH_SIZE,
+                    )
+                yield emails
+        finally:
+            chunks.close()
+            if executor is not None:
+                executor.shutdown()
+
+    def update_build(self, **kwargs):
+        """
+        Updates the build fields in database only, so that concurrent build
+        tasks do not overwrite each other.
+        """
+        Batch._base_manager.filter(pk=self.pk).update(**kwargs)
+
+    def record_build_progress(self, count):
+        if count:
+            self.update_build(build_progress=F('build_progress') + count)
+
+    def finish_build(self):
+        """Marks the batch as ready if all its recipients were built."""
+        Batch._base_manager.filter(
+            pk=self.pk,
+            build_state=BuildState.building.value,
+            build_progress__gte=F('build_total'),
+        ).update(build_state=BuildState.ready.value)
+
+
+class BatchEmailContentManager(models.Manager):
+    def unreferenced(self):
+        qs = self.get_queryset()
+        for field in BatchEmail.CONTENT_FIELDS:
+            field = field + '_content'
+            qs = qs.exclude(
+                pk__in=BatchEmail.objects.filter(
+                    **{field + '__isnull': False}
+                ).values(field)
+            )
+        return qs
+
+    def prune(self):
+        """
+        Deletes the unreferenced contents and returns their number, or None
+        if they could still be used by the batches being built.
+        """
+        connection = connections[self.db]
+        with transaction.atomic(using=self.db):
+            if connection.vendor == 'postgresql':
+                # waits for the chunks of emails being saved by builds, and
+                # holds the next ones until the contents are deleted
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE'.format(
+                            connection.ops.quote_name(
+                                self.model._meta.db_table
+                            )
+                        )
+                    )
+            elif (
+                # SQLite serializes writes: builds write the contents and
+                # the emails of a chunk in a single transaction
+                connection.vendor != 'sqlite'
+                and Batch.objects.filter(
+                    build_state=BuildState.building.value
+                ).exists()
+            ):
+                return None
+            deleted, _ = self.unreferenced().delete()
+        return deleted
+
+
+class BatchEmailContent(models.Model):
+    """
+    A rendered part of emails (subject, body or HTML body), stored once for
+    all the emails that have the same content.
+    """
+
+    hash = models.CharField(max_length=64, primary_key=True)
+    content = CompressedTextField()
+
+    objects = BatchEmailContentManager()
+
+    @classmethod
+    def for_content(cls, content):
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        return cls(hash=digest, content=content)
+
+
+def stored_content(name):
+    """
+    Property for a rendered part of an email, stored either in a shared
+    BatchEmailContent or in its own text field. It is not a model field:
+    querysets are filtered on it with BatchEmail.content_filter().
+    """
+    text_attr = name + '_text'
+    content_attr = name + '_content'
+
+    def get(self):
+        content = getattr(self, content_attr)
+        if content is not None:
+            return content.content
+        return getattr(self, text_attr)
+
+    def set(self, value):
+        setattr(self, text_attr, value)
+        setattr(self, content_attr, None)
+
+    return property(get, set)
 
 
 class BatchEmail(models.Model):
+    CONTENT_FIELDS = ('subject', 'body', 'html_body')
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     state = models.PositiveIntegerField(
         db_index=True, default=MailState.pending.value
@@ -376,16 +929,84 @@ class BatchEmail(models.Model):
     )
     to = models.EmailField(blank=False)
     unsubscribe_url = models.TextField(blank=True)
-    subject = models.TextField(blank=True)
-    body = models.TextField(blank=True)
-    html_body = models.TextField(blank=True, default="")
+    subject_text = models.TextField(blank=True, db_column='subject')
+    body_text = CompressedTextField(blank=True, db_column='body')
+    html_body_text = CompressedTextField(
+        blank=True, default="", db_column='html_body'
+    )
+    subject_content = models.ForeignKey(
+        BatchEmailContent,
+        null=True,
+        on_delete=models.PROTECT,
+        related_name='+',
+    )
+    body_content = models.ForeignKey(
+        BatchEmailContent,
+        null=True,
+        on_delete=models.PROTECT,
+        related_name='+',
+    )
+    html_body_content = models.ForeignKey(
+        BatchEmailContent,
+        null=True,
+        on_delete=models.PROTECT,
+        related_name='+',
+    )
+    # primary key of the recipient, for batches rendered at send time
+    object_id = models.CharField(max_length=255, blank=True)
 
     class Meta:
         ordering = ['state']
 
+    subject = stored_content('subject')
+    body = stored_content('body')
+    html_body = stored_content('html_body')
+
     def __str__(self):
         return '[{}] {}'.format(self.state_display, self.id)
 
+    @classmethod
+    def store_contents(cls, emails):
+        """
+        Moves the rendered parts that several of the unsaved `emails` share
+        (eg. a body without variables) to shared BatchEmailContent rows,
+        writing each distinct content only once. Parts that are unique to
+        an email within `emails` (a chunk of a batch) are left in its own
+        text fields, even if other chunks have the same ones.
+        """
+        counts = collections.Counter(
+            getattr(email, field + '_text')
+            for email in emails
+            for field in cls.CONTENT_FIELDS
+        )
+        contents = {}
+        for email in emails:
+            for field in cls.CONTENT_FIELDS:
+                text = getattr(email, field + '_text')
+                if not text or counts[text] < 2:
+                    continue
+                content = contents.get(text)
+                if content is None:
+                    content = BatchEmailContent.for_content(text)
+                    contents[text] = content
+                setattr(email, field + '_content', content)
+                setattr(email, field + '_text', "")
+        BatchEmailContent.objects.bulk_create(
+            contents.values(), ignore_conflicts=True
+        )
+
+    @classmethod
+    def content_filter(cls, field, value):
+        """
+        Returns the Q object selecting the emails whose `field` (eg.
+        'subject') is exactly `value`, wherever it is stored.
+        """
+        text = models.Q(**{field + '_text': value})
+        if not value:
+            return text & models.Q(**{field + '_content__isnull': True})
+        content = BatchEmailContent.for_content(value)
+        return text | models.Q(**{field + '_content': content.hash})
+
     @property
     def state_display(self):
         return MailState(self.state).name
@@ -398,7 +1019,26 @@ class BatchEmail(models.Model):
     def pending(self):
         return self.state == MailState.pending.value
 
+    def render(self):
+        """
+        Renders the email of a batch rendered at send time, from the template
+        and query frozen in the batch.
+        """
+        batch = self.batch
+        model, model_name, aliases = batch.frozen_query()
+        aliases = Aliases(model, aliases)
+        template = batch.frozen_template()
+        plan = batch.plan(aliases, model_name, template)
+        queryset = aliases.annotate(plan.apply(model._default_manager.all()))
+        object = queryset.get(pk=self.object_id)
+        plan.prefetch([object])
+        fields = batch.render_email(template, model_name, aliases, object)
+        for field, value in fields.items():
+            setattr(self, field, value)
+
     def build_email(self):
+        if self.object_id:
+            self.render()
         assert self.subject
         assert self.body
         # add a custom header to resolve the mail ID from bounces/complaints
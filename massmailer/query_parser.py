@@ -1,23 +1,50 @@
 import ast
+import collections
+import contextvars
 import functools
 import itertools
 import operator
 import re
+import threading
+import types
 
 import pyparsing as p
 
 from django.apps import apps
+from django.conf import settings
 from django.db import models
 from django.db.models import Q, F, Value
 from django.db.models.expressions import Combinable
 
+from massmailer import REGISTERED_ENUMS
+from massmailer.utils.cache import LRUCache
+
 
 # Improves parsing speed A LOT.
 p.ParserElement.enablePackrat()
 
-# Hack: global to expose getters to the grammar, so the grammar is built once.
-# enums, functions, models
-GETTERS = [None, None, None]
+Registries = collections.namedtuple(
+    'Registries', 'enums funcs models version', defaults=(None,)
+)
+
+# The grammar is built once, its parse actions read the registries of the
+# parser being run from this context variable.
+_registries = contextvars.ContextVar('massmailer_query_registries')
+# The packrat cache of pyparsing is shared by all the parses and only reset
+# when one starts: a parse must not reuse the results of a concurrent parse
+# made with other registries.
+_parse_lock = threading.RLock()
+
+PARSED_QUERIES = LRUCache(
+    maxsize=getattr(settings, 'MASSMAILER_QUERY_CACHE_SIZE', 256)
+)
+# Quoted strings as matched by pyparsing, or runs of comments and whitespace.
+NORMALIZE_RE = re.compile(
+    r'''("(?:[^"\n\r\\]|""|\\(?:[^x]|x[0-9a-fA-F]+))*"'''
+    r'''|'(?:[^'\n\r\\]|''|\\(?:[^x]|x[0-9a-fA-F]+))*')'''
+    r'|(?:#[^\n]*|\s)+',
+    re.S,
+)
 
 
 class ParseError(ValueError):
@@ -34,6 +61,48 @@ class ParseResult:
     aliases = {}
 
 
+class ParsedQuery:
+    """
+    What the grammar makes of a query, that does not depend on the database
+    and can be cached: results get a new queryset and aliases each time.
+    """
+
+    def __init__(self, model, q, annotations, model_name, aliases):
+        self.model = model
+        self.q = q
+        self.annotations = annotations
+        self.model_name = model_name
+        self.aliases = aliases
+
+    def result(self) -> ParseResult:
+        result = ParseResult()
+        result.queryset = self.model._default_manager.annotate(
+            **self.annotations
+        ).filter(self.q)
+        result.model_name = self.model_name
+        result.aliases = dict(self.aliases)
+        return result
+
+
+def normalize(query):
+    """
+    Removes the comments of `query` and collapses its whitespace, which
+    do not change its meaning.
+    """
+
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        return ' '
+
+    return NORMALIZE_RE.sub(replace, query).strip()
+
+
+def words(phrase):
+    """Matches the keywords of `phrase`, separated by any whitespace."""
+    return p.And([p.Keyword(word) for word in phrase.split()])
+
+
 def _find_subclasses(cls):
     found = {}
     subclasses = cls.__subclasses__()
@@ -45,11 +114,73 @@ def _find_subclasses(cls):
     return found
 
 
+# (installed models, registered enums, Registries) of default_registries()
+_defaults = None
+
+
+def default_registries(refresh_funcs=False) -> Registries:
+    """
+    Returns the read-only registries of the registered enums, of the Django
+    ORM functions and of the installed models. They are computed once, and
+    again with a new version when the app registry or the registered enums
+    change. Looking for the functions defined since is too slow to be done
+    each time: it is done with `refresh_funcs`, when a function is unknown.
+    """
+    global _defaults
+    installed = apps.get_models()  # the same list until the registry changes
+    enums = tuple(REGISTERED_ENUMS.items())
+    defaults = _defaults
+    funcs = _find_subclasses(models.Func) if refresh_funcs else None
+    if (
+        defaults is None
+        or defaults[0] is not installed
+        or defaults[1] != enums
+        or (funcs is not None and funcs != defaults[2].funcs)
+    ):
+        version = 0 if defaults is None else defaults[2].version + 1
+        if funcs is None:
+            funcs = _find_subclasses(models.Func)
+        registries = Registries(
+            types.MappingProxyType(dict(enums)),
+            types.MappingProxyType(funcs),
+            types.MappingProxyType(
+                {model.__name__: model for model in installed}
+            ),
+            version,
+        )
+        defaults = _defaults = (installed, enums, registries)
+    return defaults[2]
+
+
+def _defined_since(funcs, name):
+    """
+    Returns the Django ORM function `name` defined after the `funcs` registry
+    of a parser that loads them, or None.
+    """
+    if not isinstance(funcs, collections.ChainMap):
+        return None
+    if not isinstance(funcs.maps[-1], types.MappingProxyType):
+        return None
+    return default_registries(refresh_funcs=True).funcs.get(name)
+
+
+def _registry_key(registry, version):
+    """
+    Identifies a registry of a parser: by the version of the default registry
+    it extends and the entries added to it, or by all its entries.
+    """
+    if isinstance(registry, collections.ChainMap):
+        *added, default = registry.maps
+        if isinstance(default, types.MappingProxyType):
+            return version, tuple(frozenset(m.items()) for m in added)
+    return frozenset(registry.items())
+
+
 def build_grammar():
     func_name_gen = itertools.count(0)
 
     def parse_enum(tokens):
-        enums = GETTERS[0]
+        enums = _registries.get().enums
         enum, member = tokens[0].rsplit('.', 1)
         try:
             enum = enums[enum]
@@ -72,7 +203,7 @@ def build_grammar():
         return member.value
 
     def parse_func_call(tokens):
-        funcs = GETTERS[1]
+        funcs = _registries.get().funcs
         name = tokens.get('func_name')
         args = tokens.get('func_args', ())
         args = [
@@ -82,11 +213,13 @@ def build_grammar():
         try:
             func = funcs[name]
         except KeyError:
-            raise ParseError(f"Unknown function '{name}'.") from None
+            func = _defined_since(funcs, name)
+            if func is None:
+                raise ParseError(f"Unknown function '{name}'.") from None
         return func(*args)
 
     def parse_model(tokens):
-        models = GETTERS[2]
+        models = _registries.get().models
         name = tokens['model']
         try:
             return models[name]
@@ -295,18 +428,12 @@ def build_grammar():
         q, annotations = tokens.get('filter', (Q(), {}))
         model = tokens['model']
         model_name = model._meta.model_name
-        qs = model._default_manager.annotate(**annotations).filter(q)
         custom_model_name = tokens.get('model_name')
         if custom_model_name:
             model_name = custom_model_name[0]
-        result = ParseResult()
-        result.queryset = qs
-        result.model_name = model_name
-        result.aliases = {
-            name: field for name, field in tokens.get('aliases', [])
-        }
-        result.aliases.pop(model_name, None)
-        return result
+        aliases = {name: field for name, field in tokens.get('aliases', [])}
+        aliases.pop(model_name, None)
+        return ParsedQuery(model, q, annotations, model_name, aliases)
 
     # The grammar
     G = p.Group
@@ -367,7 +494,7 @@ def build_grammar():
         'negate'
     )
     negation_does = p.Optional(
-        p.Keyword("doesn't") | p.Keyword("does not")
+        p.Keyword("doesn't") | words("does not")
     ).setParseAction(lambda t: bool(t))('negate')
     equality = G(field + p.Suppress('=') + value).setParseAction(
         parse_equality()
@@ -403,13 +530,13 @@ def build_grammar():
     startswith = G(
         field
         + negation_does
-        + p.Suppress(p.Keyword('start with') | p.Keyword('starts with'))
+        + p.Suppress(words('start with') | words('starts with'))
         + string('value')
     ).setParseAction(parse_startswith())
     endswith = G(
         field
         + negation_does
-        + p.Suppress(p.Keyword('end with') | p.Keyword('ends with'))
+        + p.Suppress(words('end with') | words('ends with'))
         + string('value')
     ).setParseAction(parse_endswith())
     matches = G(
@@ -461,6 +588,8 @@ def build_grammar():
         + comments
     ).setParseAction(lambda t: (t['name'], t.get('field', t['name'])))
 
+    # Comments are allowed between any tokens (as whitespace), so that
+    # normalize() does not change what queries mean.
     return (
         p.stringStart()
         + comments
@@ -472,7 +601,7 @@ def build_grammar():
         + p.ZeroOrMore(alias)('aliases')
         + comments
         + p.StringEnd()
-    ).setParseAction(parse)
+    ).setParseAction(parse).ignore(p.pythonStyleComment)
 
 
 GRAMMAR = build_grammar()
@@ -483,7 +612,7 @@ class QueryParser:
     A parser for a simple grammar to write user-friendly queries that get
     translated to Django ORM.
 
-    This class is NOT thread-safe.
+    Parsers can be used concurrently, from several threads.
 
     Aggregate functions such as count() shall be registered in the
     available_funcs mapping:
@@ -527,26 +656,48 @@ class QueryParser:
     def __init__(
         self, load_django_funcs=True, load_django_models=True, load_enums=True
     ):
-        self.available_funcs = {}
-        self.available_models = {}
-        self.available_enums = {}
-
-        if load_django_funcs:
-            self.available_funcs.update(_find_subclasses(models.Func))
-
-        if load_django_models:
-            self.available_models.update(
-                {model.__name__: model for model in apps.get_models()}
+        # The default registries are shared: entries added to a parser are
+        # kept in its own layer of the mappings.
+        defaults = default_registries()
+        self.version = defaults.version
+
+        def registry(load, default):
+            return collections.ChainMap({}, default) if load else {}
+
+        self.available_funcs = registry(load_django_funcs, defaults.funcs)
+        self.available_models = registry(load_django_models, defaults.models)
+        self.available_enums = registry(load_enums, defaults.enums)
+
+    def parse(self, query: str) -> ParsedQuery:
+        token = _registries.set(
+            Registries(
+                self.available_enums,
+                self.available_funcs,
+                self.available_models,
             )
-
-        if load_enums:
-            from massmailer import REGISTERED_ENUMS
-
-            self.available_enums.update(REGISTERED_ENUMS)
+        )
+        try:
+            with _parse_lock:
+                return GRAMMAR.parseString(query)[0]
+        finally:
+            _registries.reset(token)
+
+    def registries_key(self):
+        """Identifies the registries, which change what queries mean."""
+        return tuple(
+            _registry_key(registry, self.version)
+            for registry in (
+                self.available_enums,
+                self.available_funcs,
+                self.available_models,
+            )
+        )
 
     def parse_query(self, query: str) -> ParseResult:
-        # Monkey-patch the getters.
-        GETTERS[0] = self.available_enums
-        GETTERS[1] = self.available_funcs
-        GETTERS[2] = self.available_models
-        return GRAMMAR.parseString(query)[0]
+        """
+        Parses `query`. The parses of the queries that only differ by their
+        comments and whitespace are cached.
+        """
+        key = (normalize(query), self.registries_key())
+        parsed = PARSED_QUERIES.get_or_set(key, lambda: self.parse(query))
+        return parsed.result()
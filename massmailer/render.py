@@ -0,0 +1,145 @@
+"""
+Parallel rendering of batch emails.
+
+The recipients are split in chunks of primary keys that are rendered by a
+pool of workers, each one fetching its own rows. Rendered chunks are returned
+to the caller in primary key order, whatever the order in which they are
+rendered.
+
+MASSMAILER_RENDER_EXECUTOR selects the pool: None (default) renders serially,
+'thread' and 'process' use the concurrent.futures pools, and any other value
+is the dotted path to an Executor class, instantiated with max_workers.
+Process pools cannot be started by daemonic processes, such as the workers
+of Celery's default prefork pool: these render with a thread pool instead.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+
+import django
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from massmailer.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = {
+    'thread': concurrent.futures.ThreadPoolExecutor,
+    'process': concurrent.futures.ProcessPoolExecutor,
+}
+
+
+def executor_class():
+    name = getattr(settings, 'MASSMAILER_RENDER_EXECUTOR', None)
+    if name is None:
+        return None
+    try:
+        return EXECUTORS[name]
+    except KeyError:
+        return import_string(name)
+
+
+def parallel_threshold():
+    """Batches with fewer recipients are rendered serially."""
+    return getattr(settings, 'MASSMAILER_PARALLEL_RENDER_THRESHOLD', 5000)
+
+
+def worker_count():
+    workers = getattr(settings, 'MASSMAILER_RENDER_WORKERS', None)
+    return workers or os.cpu_count() or 1
+
+
+# Connections inherited from the parent by a forked worker. They are kept
+# referenced, as closing them would also close the sessions of the parent.
+_inherited_connections = []
+
+
+def _init_worker():
+    if not apps.ready:  # spawned worker process
+        django.setup()
+    # connections inherited from a forked parent must not be reused, nor
+    # closed
+    for connection in connections.all():
+        _inherited_connections.append(connection.connection)
+        del connections[connection.alias]
+
+
+def get_executor():
+    """
+    Returns a new executor as configured in the settings, or None if
+    rendering is serial.
+    """
+    cls = executor_class()
+    if cls is None:
+        return None
+    if issubclass(cls, concurrent.futures.ProcessPoolExecutor):
+        if not multiprocessing.current_process().daemon:
+            return cls(max_workers=worker_count(), initializer=_init_worker)
+        # daemonic processes are not allowed to have children
+        logger.warning(
+            "%s cannot be used by a daemonic process, rendering with "
+            "threads instead.",
+            cls.__name__,
+        )
+        cls = concurrent.futures.ThreadPoolExecutor
+    return cls(max_workers=worker_count())
+
+
+def render_chunk(batch_id, pks, close_connections=False):
+    """
+    Renders the emails of a batch for the recipients in `pks`. Worker threads
+    close their connections, so that none outlives the pool.
+    """
+    from massmailer.models import Batch
+
+    try:
+        batch = Batch._base_manager.select_related('query', 'template').get(
+            pk=batch_id
+        )
+        return list(batch.build_emails(pks=pks))
+    finally:
+        if close_connections:
+            connections.close_all()
+
+
+def render_parallel(batch, executor, chunk_size, pk_range=None):
+    """
+    Yields the lists of unsaved emails of `batch`, rendered by `executor`
+    chunk by chunk, in primary key order.
+    """
+    close_connections = isinstance(
+        executor, concurrent.futures.ThreadPoolExecutor
+    )
+    # bound the number of rendered chunks waiting to be consumed
+    max_pending = 2 * worker_count()
+    pending = collections.deque()
+
+    def result(future):
+        emails = future.result()
+        for email in emails:
+            email.batch = batch
+        return emails
+
+    pks = batch.recipient_pks(pk_range).iterator(chunk_size)
+    try:
+        for chunk in chunked(pks, chunk_size):
+            pending.append(
+                executor.submit(
+                    render_chunk, batch.pk, chunk, close_connections
+                )
+            )
+            if len(pending) >= max_pending:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+    finally:
+        # on errors, do not render chunks that will never be saved
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,6 @@
+import django.dispatch
+
+# Sent with the `sql` and `timeout` arguments when a query run for the
+# editors or the batch confirmation is cancelled by its timeout, eg. to count
+# them in metrics.
+query_timed_out = django.dispatch.Signal()
@@ -0,0 +1,23 @@
+$(function () {
+
+  var $build_count = $('#batch-build-count');
+  var $build_progress = $('#batch-build-progress');
+
+  function poll() {
+    $.get(PROGRESS_URL)
+      .done(function (data) {
+        if (data.state !== 'building') {
+          // show the built e-mails
+          window.location.reload();
+          return;
+        }
+        var percentage = data.total ? 100 * data.progress / data.total : 0;
+        $build_count.text(data.progress + ' / ' + data.total);
+        $build_progress.css('width', percentage + '%');
+        setTimeout(poll, 2000);
+      });
+  }
+
+  setTimeout(poll, 2000);
+
+});
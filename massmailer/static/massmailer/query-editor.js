@@ -181,19 +181,47 @@ $(function () {
     useSoftTabs: true
   });
 
-  var page = 1, count = 0;
+  // keyset pagination: the cursor of the shown rows, their position and
+  // number, and the cursors of the previous and next rows
+  var cursor = null, offset = 0, shown = 0, previous = null, next = null;
+  var count = 0, approximate = false, poll = null;
+
+  function showCounts(user_count) {
+    var prefix = approximate ? '~' : '';
+    $result_count.text(prefix + count);
+    $result_user_count.text(prefix + user_count);
+    $result_page.val(shown ? (offset + 1) + '–' + (offset + shown) + ' / ' + prefix + count : '');
+  }
+
+  // estimated counts are replaced by the exact ones once they are counted
+  function pollCounts(query, attempts) {
+    poll = setTimeout(function () {
+      $.post(COUNT_URL, {query: query}).done(function (data) {
+        if (query !== editor.getSession().getDocument().getValue())
+          return;
+        if (data.count === null || data.user_count === null) {
+          if (attempts > 1)
+            pollCounts(query, attempts - 1);
+          return;
+        }
+        count = data.count;
+        approximate = false;
+        showCounts(data.user_count);
+      });
+    }, 2000);
+  }
 
   function preview() {
     var query = editor.getSession().getDocument().getValue();
+    clearTimeout(poll);
     $page_buttons.prop('disabled', true);
-    $.post(PREVIEW_URL, {query: query, page: page - 1})
+    $.post(PREVIEW_URL, {query: query, cursor: cursor || '', size: PREVIEW_SIZE})
       .done(function (data) {
         var invalid = !!data.error;
         $result_stats.toggle(!data.error);
         $result_error.toggle(invalid);
         $result_pager.toggle(!invalid);
         $result_data.toggle(!invalid);
-        $page_buttons.prop('disabled', invalid);
         $result_wrap
           .toggleClass('panel-default', !invalid)
           .toggleClass('panel-danger', invalid);
@@ -203,58 +231,63 @@ $(function () {
           $result_error.text(data.error);
         } else {
           count = data.count;
-          page = Math.max(1, Math.min(count, page));
-          $page_previous.prop('disabled', page <= 1);
-          $page_next.prop('disabled', page >= count);
+          approximate = data.approximate;
+          shown = data.results.length;
+          previous = data.previous;
+          next = data.next;
+          if (!previous) offset = 0;
+          $page_previous.prop('disabled', !previous);
+          $page_next.prop('disabled', !next);
           $result_pager.toggle(count > 0)
-          $result_page.val(page);
           $result_model.text(data.model);
           $result_model_name.text(data.model_name);
           $result_aliases.empty().append(data.aliases.map(function(a) { return $('<li/>').append($('<code/>').text(a[0] + ' → ' + a[1])); }));
-          $result_count.text(data.count);
-          $result_user_count.text(data.user_count);
+          showCounts(data.user_count);
+          if (approximate)
+            pollCounts(query, 30);
           $result_sql_query.text(data.query);
           $result_data.empty();
-          if (!data.result) return;
-          for (let name in data.result) {
-            let r = data.result[name];
-            $result_data.append($('<tr>').append($('<th>').text(name)).append($('<th>').text(r.pk)));
-            for (let field in r.fields) {
-              let value = r.fields[field];
-              let row = $('<tr>');
-              row.append($('<td>').append($('<tt>').text(field)));
-              row.append($('<td>').append($('<tt>').text(value)));
-              $result_data.append(row);
+          data.results.forEach(function (result) {
+            for (let name in result) {
+              let r = result[name];
+              $result_data.append($('<tr>').append($('<th>').text(name)).append($('<th>').text(r.pk)));
+              for (let field in r.fields) {
+                let value = r.fields[field];
+                let row = $('<tr>');
+                row.append($('<td>').append($('<tt>').text(field)));
+                row.append($('<td>').append($('<tt>').text(value)));
+                $result_data.append(row);
+              }
             }
-          }
+          });
         }
       });
   }
 
+  // the rows of an edited query are shown from the start
+  editor.getSession().getDocument().on('change', function () {
+    cursor = null;
+    offset = 0;
+  });
   editor.getSession().getDocument().on('change', debounce(preview, 500));
 
   $page_previous.click(function (e) {
     e.preventDefault();
-    if (page <= 0)
+    if (!previous)
       return;
-    page--;
+    cursor = previous;
+    offset = Math.max(0, offset - PREVIEW_SIZE);
     preview();
   });
   $page_next.click(function (e) {
     e.preventDefault();
-    if (page > count)
+    if (!next)
       return;
-    page++;
+    cursor = next;
+    offset += shown;
     preview();
   });
-  $result_page
-  .on('change', function () {
-    var want = $result_page.val();
-    page = Math.min(count, Math.max(1, want));
-    $result_page.val(want);
-    preview();
-  })
-  .on('keydown', function (e) {
+  $result_page.on('keydown', function (e) {
     // return submits the non existent form -_-
     if (e.keyCode === 13) e.preventDefault();
   });
@@ -26,12 +26,16 @@
     var $use_markdown = $('#id_use_markdown');
     var $html_enabled = $('#id_html_enabled');
     var $wrap_columns = $('#id_wrap_columns');
-    var query_id, page = 0, count = 0;
+    // keyset pagination: the cursor of the previewed recipient, its
+    // position, and the cursors of the previous and next recipients
+    var query_id, cursor = null, position = 0, previous = null, next = null;
+    var count = 0;
     var $is_marketing = $('#id_is_marketing');
 
     $("#id_useful_queries").select2().on('select2:select', function (e) {
       query_id = e.params.data.id;
-      page = 0;
+      cursor = null;
+      position = 0;
       preview();
     }).on('select2:unselect', function (e) {
       query_id = null;
@@ -41,34 +45,29 @@
     var $page_previous = $('#btn-page-previous');
     $page_previous.click(function (e) {
       e.preventDefault();
-      if (page <= 0)
+      if (!previous)
         return;
-      page--;
+      cursor = previous;
+      position--;
       preview();
     });
     var $page_next = $('#btn-page-next');
     $page_next.click(function (e) {
       e.preventDefault();
-      if (page > count)
+      if (!next)
         return;
-      page++;
+      cursor = next;
+      position++;
       preview();
     });
     var $page_buttons = $('#btn-page-previous, #btn-page-next');
 
     var $result_count = $('#result-count');
     var $result_page = $('#result-page');
-    $result_page
-      .on('change', function () {
-        var want = $result_page.val();
-        page = Math.min(count, Math.max(1, want)) - 1;
-        $result_page.val(want);
-        preview();
-      })
-      .on('keydown', function (e) {
-        // return submits the non existent form -_-
-        if (e.keyCode === 13) e.preventDefault();
-      });
+    $result_page.on('keydown', function (e) {
+      // return submits the non existent form -_-
+      if (e.keyCode === 13) e.preventDefault();
+    });
 
     function preview() {
       $page_buttons.prop('disabled', query_id == null);
@@ -82,7 +81,7 @@
         use_markdown: $use_markdown.prop('checked'),
         wrap_columns: $wrap_columns.val(),
         query: query_id,
-        page: page,
+        cursor: cursor || '',
         language: $language.val(),
         is_marketing: $is_marketing.prop('checked'),
         subject: subject_editor.getSession().getDocument().getValue(),
@@ -96,15 +95,17 @@
           }
           $('#preview-error').text('');
           count = data.query.count;
-          page = data.query.page;
+          previous = data.query.previous;
+          next = data.query.next;
+          if (!previous) position = 0;
           $result_count.text(count);
           $result_page.parent().toggle(!!count);
-          $page_previous.prop('disabled', page <= 0);
-          $page_next.prop('disabled', page >= count - 1);
+          $page_previous.prop('disabled', !previous);
+          $page_next.prop('disabled', !next);
           if (!count) {
             return;
           }
-          $result_page.val(page + 1).attr('max', count);
+          $result_page.val(position + 1);
           $('#preview-subject-error').text(data.render.subject.error ? data.render.subject.error.msg : '');
           $('#preview-plain .preview-subject > div:last-child, #preview-html .preview-subject').text(data.render.subject.content);
           $('#preview-plain .preview-header > div:last-child, #preview-html .preview-header').text(data.render.header);
@@ -1,8 +1,19 @@
 import celery
 
+from django.core.cache import caches
 from django.db import transaction
 
-from massmailer.models import MailState, BatchEmail
+from massmailer.models import (
+    COUNT_CACHE,
+    COUNT_CACHE_TIMEOUT,
+    COUNT_TIMEOUT,
+    Batch,
+    BatchEmail,
+    BuildState,
+    MailState,
+    Query,
+)
+from massmailer.utils.db import QueryTimeout
 
 
 @celery.shared_task(
@@ -17,9 +28,9 @@ def send_email(self, mail_id):
     def set_state(old_state, new_state):
         with transaction.atomic():
             try:
-                email = BatchEmail.objects.get(
-                    pk=mail_id, state=old_state.value
-                )
+                email = BatchEmail.objects.select_related(
+                    'subject_content', 'body_content', 'html_body_content'
+                ).get(pk=mail_id, state=old_state.value)
             except BatchEmail.DoesNotExist:
                 return None
             email.state = new_state.value
@@ -32,9 +43,10 @@ def send_email(self, mail_id):
         # deleted or already sent
         return
 
-    python_mail = email.build_email()
-
     try:
+        # the email can be rendered now, which can fail too (eg. when its
+        # recipient was deleted)
+        python_mail = email.build_email()
         # this can take a long time or fail
         ret = python_mail.send(fail_silently=False)
         if not ret:
@@ -52,3 +64,96 @@ def send_email(self, mail_id):
 
     # mark as sent
     set_state(MailState.sending, MailState.sent)
+
+
+@celery.shared_task(ignore_result=True)
+def build_batch(batch_id):
+    """
+    Splits the recipients of a batch in primary key ranges, and fans out one
+    build_batch_partition task per range.
+    """
+    batch = Batch._base_manager.get(pk=batch_id)
+    try:
+        if batch.render_at_send and not batch.snapshot:
+            batch.freeze()
+            batch.save(update_fields=['snapshot'])
+        partitions = list(batch.partitions())
+        total = sum(count for first_pk, last_pk, count in partitions)
+        batch.update_build(build_total=total)
+    except Exception:
+        batch.update_build(build_state=BuildState.failed.value)
+        raise
+
+    if not partitions:
+        batch.finish_build()
+    for first_pk, last_pk, count in partitions:
+        build_batch_partition.delay(batch_id, first_pk, last_pk, count)
+
+
+@celery.shared_task(ignore_result=True)
+def build_batch_partition(batch_id, first_pk, last_pk, count):
+    """
+    Builds and saves the emails of the recipients of a batch whose primary
+    key is in [first_pk, last_pk], and queues them for sending. `count` is
+    the number of recipients planned for this range.
+    """
+    batch = Batch._base_manager.select_related('query', 'template').get(
+        pk=batch_id
+    )
+    reported = 0
+    try:
+        emails_chunks = batch.create_emails(
+            pk_range=(first_pk, last_pk), count=count
+        )
+        for emails in emails_chunks:
+            for email in emails:
+                email.send_task()
+            # the recipients may have changed since the partitions were
+            # planned: never report more than `count`
+            progress = min(len(emails), count - reported)
+            batch.record_build_progress(progress)
+            reported += progress
+    except Exception:
+        batch.update_build(build_state=BuildState.failed.value)
+        raise
+    batch.record_build_progress(count - reported)
+    # the last task to finish marks the batch as ready
+    batch.finish_build()
+
+
+@celery.shared_task(ignore_result=True)
+def count_query(query):
+    """
+    Counts the recipients and the users of the `query` text exactly, for the
+    previews that showed estimates. They are made for the queries too large
+    to be counted by the editor, so they are limited by
+    MASSMAILER_COUNT_TIMEOUT instead of MASSMAILER_QUERY_TIMEOUT.
+    """
+    pending = Query.count_key(query, 'pending')
+    timed_out = False
+    try:
+        result, user_qs = Query.execute(query, check_exists=False)
+        for queryset, counted in (
+            (result.queryset, 'recipients'),
+            (user_qs, 'users'),
+        ):
+            Query.count(
+                query, queryset, counted, sandboxed=True, timeout=COUNT_TIMEOUT
+            )
+    except QueryTimeout:
+        timed_out = True
+        raise
+    finally:
+        if timed_out:
+            # the previews keep their estimates, without counting again for
+            # a while
+            caches[COUNT_CACHE].set(pending, True, COUNT_CACHE_TIMEOUT)
+        else:
+            caches[COUNT_CACHE].delete(pending)
+
+
+def count_query_later(query):
+    """Queues count_query(), unless it is already queued for `query`."""
+    pending = Query.count_key(query, 'pending')
+    if caches[COUNT_CACHE].add(pending, True, COUNT_CACHE_TIMEOUT):
+        count_query.delay(query)
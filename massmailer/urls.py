@@ -28,6 +28,7 @@ query_patterns = [
     path(
         'preview', massmailer.views.QueryPreviewView.as_view(), name='preview'
     ),
+    path('count', massmailer.views.QueryCountView.as_view(), name='count'),
     path(
         '<int:id>', massmailer.views.UpdateQueryView.as_view(), name='update'
     ),
@@ -40,6 +41,11 @@ query_patterns = [
 
 batch_obj_patterns = [
     path('', massmailer.views.BatchDetailView.as_view(), name='detail'),
+    path(
+        'progress',
+        massmailer.views.BatchProgressView.as_view(),
+        name='progress',
+    ),
     path(
         'retry',
         massmailer.views.BatchRetryView.as_view(),
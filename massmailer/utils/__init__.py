@@ -1,12 +1,19 @@
 from contextlib import contextmanager
 
+import bleach
+import itertools
+import markdown
 import re
+import threading
 import uuid
 
+from django.conf import settings
 from markdown.extensions import Extension
 from markdown.postprocessors import Postprocessor
 from markdown.preprocessors import Preprocessor
 
+from massmailer.utils.cache import LRUCache
+
 PATTERN = re.compile(r'\{([\{%s])\s*(?P<data>.*?)\s*\1\}')
 
 
@@ -16,11 +23,11 @@ class Pre(Preprocessor):
         self.ext = ext
 
     def replace(self, m):
-        key = '§§§{}§§§'.format(uuid.uuid4())
-        self.ext.placeholders[key] = '{{{tag} {data} {tag}}}'.format(
-            tag=m.group(1), data=m.group('data')
+        return self.ext.store(
+            '{{{tag} {data} {tag}}}'.format(
+                tag=m.group(1), data=m.group('data')
+            )
         )
-        return key
 
     def run(self, lines):
         return [PATTERN.sub(self.replace, line) for line in lines]
@@ -32,25 +39,67 @@ class Post(Postprocessor):
         self.ext = ext
 
     def replace(self, m):
-        return self.ext.placeholders[m.group(1)]
+        return self.ext.placeholders[int(m.group(1))]
 
     def run(self, text):
         if not self.ext.placeholders:
             return text
-        pat = '({})'.format(
-            '|'.join(re.escape(_) for _ in self.ext.placeholders)
-        )
-        return re.sub(pat, self.replace, text)
+        return self.ext.pattern.sub(self.replace, text)
 
 
 class JinjaEscapeExtension(Extension):
+    """
+    Protects the Jinja tags of a Markdown template from the conversion. Each
+    tag is replaced by a numbered placeholder, restored in a single pass
+    once the HTML is generated.
+    """
+
     def __init__(self):
         super(JinjaEscapeExtension, self).__init__()
-        self.placeholders = {}
+        # random, so that placeholders cannot be forged in the template
+        self.token = uuid.uuid4().hex
+        self.pattern = re.compile(r'§§§{}-(\d+)§§§'.format(self.token))
+        self.placeholders = []
+
+    def store(self, tag):
+        key = '§§§{}-{}§§§'.format(self.token, len(self.placeholders))
+        self.placeholders.append(tag)
+        return key
+
+    def reset(self):
+        self.placeholders = []
 
     def extendMarkdown(self, md):
-        md.preprocessors.add('jinja-pre', Pre(self), '_begin')
-        md.postprocessors.add('jinja-post', Post(self), '_end')
+        md.registerExtension(self)
+        # first preprocessor and last postprocessor
+        md.preprocessors.register(Pre(self), 'jinja-pre', 100)
+        md.postprocessors.register(Post(self), 'jinja-post', 0)
+
+
+MARKDOWN_CONVERSIONS = LRUCache(
+    maxsize=getattr(settings, 'MASSMAILER_MARKDOWN_CACHE_SIZE', 128)
+)
+_markdown = threading.local()
+
+
+def markdown_to_html(text):
+    """
+    Converts the plaintext Markdown template `text` to an HTML template,
+    keeping its Jinja tags.
+    """
+
+    def convert():
+        md = getattr(_markdown, 'md', None)
+        if md is None:
+            md = _markdown.md = markdown.Markdown(
+                extensions=[JinjaEscapeExtension()]
+            )
+        try:
+            return md.convert(bleach.clean(text))
+        finally:
+            md.reset()
+
+    return MARKDOWN_CONVERSIONS.get_or_set(text, convert)
 
 
 def get_attr_rec(item, field):
@@ -73,3 +122,16 @@ def get_field_rec(model, field):
         model = model._meta.get_field(key).related_model
 
     return model
+
+
+def chunked(iterable, size):
+    '''
+    Splits an iterable in lists of `size` items, without consuming more than
+    one chunk at a time.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
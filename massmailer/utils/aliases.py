@@ -0,0 +1,73 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F
+
+from massmailer.utils import get_attr_rec
+
+ANNOTATION_PREFIX = 'massmailer_alias_'
+
+
+def is_scalar_path(model, field):
+    """
+    Whether `field` (with the field__subfield syntax) follows forward
+    single-valued relations of `model` down to a column, eg.
+    `user__profile__school__name`.
+    """
+    *relations, column = field.split('__')
+    try:
+        for name in relations:
+            f = model._meta.get_field(name)
+            if f.auto_created or not (f.many_to_one or f.one_to_one):
+                return False
+            model = f.related_model
+        f = model._meta.get_field(column)
+    except FieldDoesNotExist:
+        return False
+    return f.concrete and not f.is_relation
+
+
+class Aliases:
+    """
+    Evaluates the aliases of a query for its objects. Aliases of columns of
+    related models are selected in SQL, with the object, instead of being
+    walked one relation at a time; the others are walked in Python.
+
+    aliases = Aliases(model, {'email': 'user__email', 'user': 'user'})
+    for object in aliases.annotate(queryset):
+        aliases.context(object)  # {'email': ..., 'user': <User>}
+    """
+
+    def __init__(self, model, aliases):
+        self.model = model
+        self.aliases = aliases
+        self.annotations = {
+            alias: ANNOTATION_PREFIX + alias
+            for alias, field in aliases.items()
+            if '__' in field and is_scalar_path(model, field)
+        }
+
+    def walked(self):
+        """The (alias, field) pairs evaluated on the objects."""
+        return [
+            (alias, field)
+            for alias, field in self.aliases.items()
+            if alias not in self.annotations
+        ]
+
+    def annotate(self, queryset):
+        if not self.annotations:
+            return queryset
+        return queryset.annotate(
+            **{
+                name: F(self.aliases[alias])
+                for alias, name in self.annotations.items()
+            }
+        )
+
+    def value(self, object, alias):
+        name = self.annotations.get(alias)
+        if name is not None:
+            return getattr(object, name)
+        return get_attr_rec(object, self.aliases[alias])
+
+    def context(self, object):
+        return {alias: self.value(object, alias) for alias in self.aliases}
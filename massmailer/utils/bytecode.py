@@ -0,0 +1,124 @@
+import hashlib
+import os
+
+import jinja2
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+class FileSystemBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    Jinja's filesystem bytecode cache, that can also prune the entry of a
+    single template.
+
+    MASSMAILER_BYTECODE_CACHE = {
+        'BACKEND': 'massmailer.utils.bytecode.FileSystemBytecodeCache',
+        'OPTIONS': {'directory': '/var/cache/massmailer'},
+    }
+    """
+
+    def remove(self, name):
+        path = os.path.join(
+            self.directory, self.pattern % (self.get_cache_key(name),)
+        )
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class DjangoCacheBytecodeCache(jinja2.BytecodeCache):
+    """
+    Bytecode cache stored in one of the Django cache backends, eg. a
+    DatabaseCache shared by every web and Celery process.
+
+    MASSMAILER_BYTECODE_CACHE = {
+        'BACKEND': 'massmailer.utils.bytecode.DjangoCacheBytecodeCache',
+        'OPTIONS': {'cache': 'massmailer', 'timeout': None},
+    }
+    """
+
+    def __init__(
+        self, cache='default', prefix='massmailer-bytecode-', timeout=None
+    ):
+        self.cache = caches[cache]
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def load_bytecode(self, bucket):
+        data = self.cache.get(self.prefix + bucket.key)
+        if data is not None:
+            bucket.bytecode_from_string(data)
+
+    def dump_bytecode(self, bucket):
+        self.cache.set(
+            self.prefix + bucket.key,
+            bucket.bytecode_to_string(),
+            self.timeout,
+        )
+
+    def remove(self, name):
+        self.cache.delete(self.prefix + self.get_cache_key(name))
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Returns the bytecode cache configured by MASSMAILER_BYTECODE_CACHE, or
+    None if there is none.
+    """
+    global _cache
+    config = getattr(settings, 'MASSMAILER_BYTECODE_CACHE', None)
+    if config is None:
+        return None
+    if _cache is None:
+        backend = import_string(config['BACKEND'])
+        _cache = backend(**config.get('OPTIONS', {}))
+    return _cache
+
+
+@receiver(setting_changed)
+def reset_cache(setting, **kwargs):
+    global _cache
+    if setting == 'MASSMAILER_BYTECODE_CACHE':
+        _cache = None
+
+
+def template_name(prefix, source):
+    """
+    Name of a template in the bytecode cache. It contains the source checksum,
+    so that cache entries are keyed on the source.
+    """
+    checksum = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    return '{}/{}'.format(prefix, checksum)
+
+
+def compile_template(env, source, name, parse=None):
+    """
+    Same as env.from_string(source), but loads the compiled code from the
+    bytecode cache of `env` when it is available. `parse` may return the
+    already parsed source, when it has to be compiled.
+    """
+    bcc = env.bytecode_cache
+    if bcc is None:
+        return env.from_string(parse() if parse else source)
+    bucket = bcc.get_bucket(env, name, None, source)
+    code = bucket.code
+    if code is None:
+        code = env.compile(parse() if parse else source, name)
+        bucket.code = code
+        bcc.set_bucket(bucket)
+    return env.template_class.from_code(env, code, env.make_globals(None))
+
+
+def prune(env, name):
+    """Removes a template from the bytecode cache of `env`."""
+    remove = getattr(env.bytecode_cache, 'remove', None)
+    if remove is not None:
+        remove(name)
@@ -0,0 +1,64 @@
+import collections
+import threading
+
+
+class LRUCache:
+    """
+    A thread-safe mapping bounded to `maxsize` entries, evicting the least
+    recently used ones first. Lookups are counted as hits and misses.
+
+    cache = LRUCache(maxsize=2)
+    cache.get_or_set('a', lambda: expensive('a'))  # miss, computed
+    cache.get_or_set('a', lambda: expensive('a'))  # hit
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get_or_set(self, key, factory):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return value
+        # Computed without holding the lock, so that a slow factory does not
+        # serialize lookups of other keys.
+        value = factory()
+        with self._lock:
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def evict(self, predicate):
+        """Removes every entry whose key matches `predicate`."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
@@ -1,4 +1,290 @@
-from django.db.models import Case, When, Value, Sum, IntegerField
+import base64
+import contextlib
+import json
+import logging
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.models import Case, When, Value, Sum, IntegerField, TextField
+
+from massmailer.signals import query_timed_out
+
+logger = logging.getLogger(__name__)
+
+# Maximum duration (in seconds) of each query run for the editors and the
+# batch confirmation, None for no limit.
+QUERY_TIMEOUT = getattr(settings, 'MASSMAILER_QUERY_TIMEOUT', 10)
+
+# Prefix of compressed values. Texts that do not start with it are stored
+# as-is, so that rows written before compression still read correctly.
+COMPRESSED_MARKER = '\x01z'
+
+
+def compress(text, min_length=0, level=6):
+    """
+    Compresses `text` to a marked string, unless it is shorter than
+    `min_length` or does not shrink.
+    """
+    if len(text) < min_length:
+        return text
+    data = zlib.compress(text.encode('utf-8'), level)
+    compressed = COMPRESSED_MARKER + base64.b64encode(data).decode('ascii')
+    if len(compressed) >= len(text):
+        return text
+    return compressed
+
+
+def decompress(value):
+    if not value.startswith(COMPRESSED_MARKER):
+        return value
+    data = base64.b64decode(value[len(COMPRESSED_MARKER) :])
+    return zlib.decompress(data).decode('utf-8')
+
+
+class CompressedTextField(TextField):
+    """
+    TextField stored zlib-compressed in the database. The column is still
+    text (the compressed data is base64 encoded), and values shorter than
+    `min_length` are not compressed.
+
+    Lookups are made against the stored value, so only exact and isnull
+    lookups on short values are meaningful.
+    """
+
+    def __init__(self, *args, min_length=256, level=6, **kwargs):
+        self.min_length = min_length
+        self.level = level
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.min_length != 256:
+            kwargs['min_length'] = self.min_length
+        if self.level != 6:
+            kwargs['level'] = self.level
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress(value)
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            return decompress(value)
+        return super().to_python(value)
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return value
+        return compress(value, self.min_length, self.level)
+
+
+def estimate_count(queryset, limit=1000):
+    """
+    Returns (count, exact): a quick estimate of the number of rows of
+    `queryset`. On PostgreSQL, it is the row estimate of the query planner.
+    Elsewhere the rows are counted up to `limit`, which is a lower bound
+    when it is reached.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            (plan,) = cursor.fetchone()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows']), False
+    count = queryset[:limit].count()
+    return count, count < limit
+
+
+class QueryTimeout(Exception):
+    """A query run by sandboxed_queries() was cancelled by its timeout."""
+
+    def __init__(self, timeout):
+        super().__init__(timeout)
+        self.timeout = timeout
+
+
+class StatementLimit:
+    """
+    Cancels the statements that take more than `timeout` seconds with the
+    cancel() method of the DB-API connection, when the driver has one.
+    Subclasses use the mechanisms of the database backends instead, and make
+    the statements read-only when they can (`read_only` after enter()).
+    """
+
+    def __init__(self, connection, timeout, outermost):
+        self.connection = connection
+        self.timeout = timeout
+        self.outermost = outermost
+        self.cancelled = False
+        self.timer = None
+        self.read_only = False
+
+    def enter(self):
+        """Called at the start of the block."""
+
+    def exit(self):
+        """Called at the end of the block, even after an error."""
+
+    def start(self):
+        """Called before each statement."""
+        cancel = getattr(self.connection.connection, 'cancel', None)
+        if self.timeout and cancel is not None:
+            self.timer = threading.Timer(self.timeout, self.cancel, [cancel])
+            self.timer.start()
+
+    def cancel(self, cancel):
+        self.cancelled = True
+        cancel()
+
+    def stop(self):
+        """Called after each statement."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def timed_out(self, error):
+        return self.cancelled
+
+
+class PostgreSQLStatementLimit(StatementLimit):
+    def enter(self):
+        with self.connection.cursor() as cursor:
+            # also within a savepoint, eg. with ATOMIC_REQUESTS; both are
+            # reverted by the rollback of the block
+            cursor.execute('SET LOCAL transaction_read_only = on')
+            self.read_only = True
+            if self.timeout:
+                cursor.execute(
+                    'SET LOCAL statement_timeout = %s',
+                    [int(self.timeout * 1000)],
+                )
+
+    def start(self):
+        pass
+
+    def timed_out(self, error):
+        # query_canceled
+        return getattr(error.__cause__, 'pgcode', None) == '57014'
+
+
+class MySQLStatementLimit(StatementLimit):
+    def enter(self):
+        with self.connection.cursor() as cursor:
+            # MySQL cannot make a transaction read-only once it is started:
+            # within another transaction (eg. with ATOMIC_REQUESTS), the
+            # statements are only rolled back
+            if self.outermost:
+                cursor.execute('SET TRANSACTION READ ONLY')
+                self.read_only = True
+            cursor.execute('SELECT @@SESSION.max_execution_time')
+            (self.saved,) = cursor.fetchone()
+            cursor.execute(
+                'SET SESSION max_execution_time = %s',
+                [int((self.timeout or 0) * 1000)],
+            )
+
+    def exit(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SET SESSION max_execution_time = %s', [self.saved])
+
+    def start(self):
+        pass
+
+    def timed_out(self, error):
+        # ER_QUERY_TIMEOUT
+        return bool(error.args) and error.args[0] == 3024
+
+
+class SQLiteStatementLimit(StatementLimit):
+    # number of SQLite virtual machine instructions between deadline checks
+    PROGRESS_STEPS = 10000
+
+    def enter(self):
+        self.deadline = None
+        with self.connection.cursor() as cursor:
+            cursor.execute('PRAGMA query_only')
+            (self.saved,) = cursor.fetchone()
+            cursor.execute('PRAGMA query_only = 1')
+        self.read_only = True
+        self.connection.connection.set_progress_handler(
+            self.progress, self.PROGRESS_STEPS
+        )
+
+    def exit(self):
+        self.connection.connection.set_progress_handler(None, 0)
+        with self.connection.cursor() as cursor:
+            cursor.execute('PRAGMA query_only = %d' % self.saved)
+
+    def progress(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.cancelled = True
+            return 1  # interrupts the statement
+        return 0
+
+    def start(self):
+        if self.timeout:
+            self.deadline = time.monotonic() + self.timeout
+
+    def stop(self):
+        self.deadline = None
+
+
+STATEMENT_LIMITS = {
+    'postgresql': PostgreSQLStatementLimit,
+    'mysql': MySQLStatementLimit,
+    'sqlite': SQLiteStatementLimit,
+}
+
+
+@contextlib.contextmanager
+def sandboxed_queries(timeout=QUERY_TIMEOUT, using=DEFAULT_DB_ALIAS):
+    """
+    Runs the queries of the block in a transaction that is read-only where
+    the backend supports it, and always rolled back. Raises QueryTimeout
+    when one of them takes more than `timeout` seconds. Querysets must be
+    evaluated within the block to be limited.
+    """
+    connection = connections[using]
+    outermost = not connection.in_atomic_block
+    limit_class = STATEMENT_LIMITS.get(connection.vendor, StatementLimit)
+    limit = limit_class(connection, timeout, outermost)
+
+    def execute(execute, sql, params, many, context):
+        limit.start()
+        try:
+            return execute(sql, params, many, context)
+        except DatabaseError as e:
+            if not limit.timed_out(e):
+                raise
+            logger.warning("Query cancelled after %ss: %s", timeout, sql)
+            query_timed_out.send(sender=None, sql=sql, timeout=timeout)
+            raise QueryTimeout(timeout) from e
+        finally:
+            limit.stop()
+
+    entered = False
+    try:
+        with transaction.atomic(using=using):
+            limit.enter()
+            entered = True
+            try:
+                with connection.execute_wrapper(execute):
+                    yield
+            finally:
+                transaction.set_rollback(True, using=using)
+    finally:
+        # once the transaction is over, as it may have been aborted
+        if entered:
+            limit.exit()
 
 
 class CaseMapping(Case):
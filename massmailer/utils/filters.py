@@ -1,25 +1,121 @@
 import babel
 import babel.dates
+import contextlib
+import contextvars
+import datetime
+import decimal
+import functools
 import jinja2
 
+from massmailer import register_filter
 
-def get_locale(ctx):
-    language_code = ctx['language']
+_memo = contextvars.ContextVar('massmailer_filter_memo', default=None)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_locale(language_code):
     return babel.Locale.parse(language_code, sep='-')
 
 
+def get_locale(ctx):
+    return parse_locale(ctx['language'])
+
+
+@contextlib.contextmanager
+def memoize(memo):
+    """
+    Reuses the results of pure filters stored in `memo` (an LRUCache) while
+    rendering in this block, eg. the same event date formatted for every
+    recipient of a batch.
+    """
+    token = _memo.set(memo)
+    try:
+        yield memo
+    finally:
+        _memo.reset(token)
+
+
+def _pass_arg(decorator):
+    return decorator(lambda: None).jinja_pass_arg
+
+
+PASS_ARGS = {
+    _pass_arg(jinja2.pass_context): lambda ctx: ctx,
+    _pass_arg(jinja2.pass_eval_context): lambda ctx: ctx.eval_ctx,
+    _pass_arg(jinja2.pass_environment): lambda ctx: ctx.environment,
+}
+
+
+def _arg_key(value):
+    """
+    Returns the memo key of a filter argument: equal values of different
+    types, timezones or precisions can be formatted differently.
+    """
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        return type(value), value, value.tzinfo
+    if isinstance(value, decimal.Decimal):
+        return type(value), value.as_tuple()
+    return type(value), value
+
+
+def memoized(f):
+    """Wraps the pure filter `f` to use the memo of memoize()."""
+    pass_arg = PASS_ARGS.get(getattr(f, 'jinja_pass_arg', None))
+
+    @jinja2.pass_context
+    @functools.wraps(f)
+    def wrapper(ctx, *args, **kwargs):
+        def call():
+            if pass_arg is not None:
+                return f(pass_arg(ctx), *args, **kwargs)
+            return f(*args, **kwargs)
+
+        memo = _memo.get()
+        if memo is None:
+            return call()
+        key = (
+            f,
+            ctx.get('language'),
+            ctx.eval_ctx.autoescape,
+            tuple(_arg_key(arg) for arg in args),
+            tuple(
+                (name, _arg_key(arg)) for name, arg in sorted(kwargs.items())
+            ),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return call()
+        return memo.get_or_set(key, call)
+
+    return wrapper
+
+
+def template_filters():
+    """Returns the registered filters, pure ones being memoized."""
+    from massmailer import REGISTERED_FILTERS
+
+    return {
+        name: memoized(f) if pure else f
+        for name, (f, pure) in REGISTERED_FILTERS.items()
+    }
+
+
+@register_filter(pure=True)
 @jinja2.pass_context
 def format_datetime(ctx, date, format='full'):
     locale = get_locale(ctx)
     return babel.dates.format_datetime(date, format=format, locale=locale)
 
 
+@register_filter(pure=True)
 @jinja2.pass_context
 def format_date(ctx, date, format='full'):
     locale = get_locale(ctx)
     return babel.dates.format_date(date, format=format, locale=locale)
 
 
+@register_filter(pure=True)
 @jinja2.pass_context
 def format_time(ctx, date, format='full'):
     locale = get_locale(ctx)
@@ -0,0 +1,219 @@
+"""
+Linkification of rendered HTML emails, done once per template instead of
+once per email.
+
+While an HTML template is rendered, each {{ }} output is replaced by a
+numbered placeholder and its value is set aside. The rendered skeleton is
+the same for all the recipients that go through the same branches of the
+template, so it is linkified once and cached. The values are then put back
+in the linkified skeleton, which gives the same result as linkifying the
+whole email as long as:
+
+- every placeholder of the skeleton is found once after linkification, in
+  a text or a quoted attribute value, and not next to characters that could
+  join it to a link;
+- the values are not URL-like and have no markup or characters that the
+  HTML parser would normalize.
+
+Otherwise the whole email is linkified, as before.
+"""
+
+import contextlib
+import contextvars
+import re
+
+import bleach
+import bleach.linkifier
+from django.conf import settings
+from jinja2 import nodes
+from markupsafe import Markup, escape
+
+from massmailer.utils.cache import LRUCache
+
+OPEN, CLOSE = '\ufdd0', '\ufdd1'  # noncharacters, never in real texts
+PLACEHOLDER_RE = re.compile('{}(\\d+){}'.format(OPEN, CLOSE))
+# texts that the HTML parser and serializer of bleach leave untouched
+INERT_RE = re.compile(
+    r'(?:[^&<>"\'\x00-\x08\x0b-\x1f\x7f-\x9f\ufdd0-\ufdef\ufffe\uffff]'
+    r'|&(?:amp|lt|gt|#34|#39);)*'
+)
+PROBE = 'x'
+# splits the attribute values that are not quoted in the template
+ATTRIBUTE_PROBE = 'x y'
+# characters that end or alter unquoted attribute values
+UNQUOTED_RE = re.compile(r'[\s&"\'=<>`]')
+
+TEXT, ATTRIBUTE, UNQUOTED = 'text', 'attribute', 'unquoted'
+
+# Template constructs that use or transform the output of other outputs.
+CAPTURING_NODES = (
+    nodes.FilterBlock,
+    nodes.AssignBlock,
+    nodes.Macro,
+    nodes.CallBlock,
+    nodes.EvalContextModifier,
+    nodes.Block,
+    nodes.Extends,
+    nodes.Include,
+    nodes.Import,
+    nodes.FromImport,
+)
+
+SKELETONS = LRUCache(
+    maxsize=getattr(settings, 'MASSMAILER_LINKIFY_CACHE_SIZE', 64)
+)
+_values = contextvars.ContextVar('massmailer_linkify_values', default=None)
+
+
+def finalize(value):
+    """
+    Jinja finalize hook of the HTML environment: outside of render(), it
+    leaves values as they are.
+    """
+    values = _values.get()
+    if values is None:
+        return value
+    values.append(str(escape(value)))
+    return Markup('{}{}{}'.format(OPEN, len(values) - 1, CLOSE))
+
+
+def supports(ast):
+    """Whether the placeholders of the parsed template can be trusted."""
+    return not any(True for _ in ast.find_all(CAPTURING_NODES))
+
+
+@contextlib.contextmanager
+def placeholders():
+    """Replaces the outputs rendered in this block by placeholders."""
+    values = []
+    token = _values.set(values)
+    try:
+        yield values
+    finally:
+        _values.reset(token)
+
+
+def substitute(text, values):
+    return PLACEHOLDER_RE.sub(lambda m: values[int(m.group(1))], text)
+
+
+def _bounded(text, i, step, punctuation):
+    while 0 <= i < len(text) and text[i] in punctuation:
+        i += step
+    return not 0 <= i < len(text) or text[i].isspace() or text[i] in '<>'
+
+
+def _position(linked, start, end):
+    """Returns where a placeholder is in the linkified HTML, if it is safe."""
+    tag_start = linked.rfind('<', 0, start)
+    if tag_start > linked.rfind('>', 0, start):
+        # attribute values are always quoted by bleach, but not necessarily
+        # in the template, which compile() checks
+        if linked.count('"', tag_start, start) % 2 == 1:
+            return ATTRIBUTE
+        return None
+    if _bounded(linked, start - 1, -1, '("\'') and _bounded(
+        linked, end, 1, '.,;:!?)"\''
+    ):
+        return TEXT
+    return None
+
+
+class Skeleton:
+    def __init__(self, parts, positions):
+        # static texts alternating with placeholder numbers
+        self.parts = parts
+        self.positions = positions
+
+    @classmethod
+    def compile(cls, skeleton, count):
+        """
+        Linkifies a skeleton with `count` placeholders. Returns None if the
+        values cannot be put back in the result, and False if the skeleton
+        has other placeholder-like texts.
+        """
+        numbers = [int(n) for n in PLACEHOLDER_RE.findall(skeleton)]
+        if sorted(numbers) != list(range(count)) or not (
+            skeleton.count(OPEN) == skeleton.count(CLOSE) == count
+        ):
+            return False
+        linked = bleach.linkify(skeleton)
+        if not linked.count(OPEN) == linked.count(CLOSE) == count:
+            return None
+        positions = {}
+        for match in PLACEHOLDER_RE.finditer(linked):
+            number = int(match.group(1))
+            position = _position(linked, match.start(), match.end())
+            if position is None or number in positions:
+                return None
+            positions[number] = position
+        if len(positions) != count:
+            return None
+        # the links must not depend on the placeholders, and attribute
+        # values with spaces must stay in their attribute
+        probes = [
+            ATTRIBUTE_PROBE if positions[n] == ATTRIBUTE else PROBE
+            for n in range(count)
+        ]
+        if count and not cls.probe(skeleton, linked, probes):
+            if not cls.probe(skeleton, linked, [PROBE] * count):
+                return None
+            # some attributes are not quoted in the template
+            for number, position in positions.items():
+                if position == ATTRIBUTE:
+                    positions[number] = UNQUOTED
+        parts = PLACEHOLDER_RE.split(linked)
+        parts[1::2] = [int(n) for n in parts[1::2]]
+        return cls(parts, positions)
+
+    @staticmethod
+    def probe(skeleton, linked, probes):
+        return bleach.linkify(substitute(skeleton, probes)) == substitute(
+            linked, probes
+        )
+
+    def is_inert(self, number, value):
+        if not INERT_RE.fullmatch(value):
+            return False
+        position = self.positions[number]
+        if position == UNQUOTED and UNQUOTED_RE.search(value):
+            return False
+        if position != TEXT:
+            # eg. a mailto: link gets no rel="nofollow"
+            return ':' not in value
+        return not bleach.linkifier.URL_RE.search(value)
+
+    def substitute(self, values):
+        """
+        Returns the linkified email, or None if some values could change
+        the links.
+        """
+        result = []
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                result.append(part)
+                continue
+            value = values[part]
+            if not self.is_inert(part, value):
+                return None
+            result.append(value)
+        return ''.join(result)
+
+
+def linkify(skeleton, values):
+    """
+    Linkifies the email rendered as `skeleton`, with the output `values` set
+    aside by placeholders(). Returns None if the email must be rendered and
+    linkified again without placeholders.
+    """
+    compiled = SKELETONS.get_or_set(
+        (skeleton, len(values)),
+        lambda: Skeleton.compile(skeleton, len(values)),
+    )
+    if compiled is False:
+        return None
+    if compiled is not None:
+        result = compiled.substitute(values)
+        if result is not None:
+            return result
+    return bleach.linkify(substitute(skeleton, values))
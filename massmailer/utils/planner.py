@@ -0,0 +1,170 @@
+"""
+Planning of the joins needed to render templates.
+
+The attribute chains of a template that start from the recipient (or from
+one of the aliases of the query) are mapped onto the relations of its model,
+so that they are fetched with select_related() and prefetch_related()
+instead of one query per recipient and relation.
+
+    {{ user.profile.school.name }}         select_related('profile__school')
+    {% for g in user.groups.all() %}       prefetch_related('groups')
+"""
+
+import functools
+
+from django.db.models import prefetch_related_objects
+from django.db.models.fields.reverse_related import ForeignObjectRel
+from jinja2 import nodes
+
+
+class Plan:
+    def __init__(self):
+        self.select_related = set()
+        self.prefetch_related = set()
+
+    def __repr__(self):
+        return '<Plan select_related={} prefetch_related={}>'.format(
+            sorted(self.select_related), sorted(self.prefetch_related)
+        )
+
+    def add(self, path, many):
+        """Adds a path, keeping only the longest of the nested paths."""
+        paths = self.prefetch_related if many else self.select_related
+        path = '__'.join(path)
+        if any(p == path or p.startswith(path + '__') for p in paths):
+            return
+        paths -= {p for p in paths if path.startswith(p + '__')}
+        paths.add(path)
+
+    def apply(self, queryset):
+        """
+        Adds the joins to `queryset`. Prefetches are not made by iterator(),
+        see prefetch().
+        """
+        if self.select_related:
+            queryset = queryset.select_related(*sorted(self.select_related))
+        return queryset
+
+    def prefetch(self, objects):
+        """Prefetches the multi-valued relations of a list of objects."""
+        if self.prefetch_related:
+            prefetch_related_objects(objects, *sorted(self.prefetch_related))
+
+
+@functools.lru_cache(maxsize=None)
+def relations(model):
+    """
+    Maps the attribute names of the relations of `model` to
+    (field, select_related name, prefetch_related name).
+    """
+    result = {}
+    for field in model._meta.get_fields():
+        if not field.is_relation or field.related_model is None:
+            continue  # eg. generic foreign keys
+        if isinstance(field, ForeignObjectRel):
+            accessor = field.get_accessor_name()
+            if accessor is None:  # related_name='+'
+                continue
+            result[accessor] = (
+                field,
+                field.field.related_query_name(),
+                accessor,
+            )
+        else:
+            result[field.name] = (field, field.name, field.name)
+    return result
+
+
+def resolve(model, attrs):
+    """
+    Maps the attribute chain `attrs` onto relations of `model`, until an
+    attribute is not a relation. Returns (path, many, rest) where `path` is
+    the list of lookups of the relations, `many` whether one of them is
+    multi-valued (and must be prefetched) and `rest` the attributes left.
+    """
+    select_path, prefetch_path = [], []
+    many = False
+    for i, attr in enumerate(attrs):
+        relation = relations(model).get(attr)
+        if relation is None:
+            break
+        field, select_name, prefetch_name = relation
+        many = many or field.one_to_many or field.many_to_many
+        select_path.append(select_name)
+        prefetch_path.append(prefetch_name)
+        model = field.related_model
+    else:
+        i = len(attrs)
+    path = prefetch_path if many else select_path
+    return path, many, attrs[i:]
+
+
+def attribute_chain(node):
+    """
+    Returns (root name, [attributes]) for `user.a.b`, `user['a'].b` and
+    `user.a.all()` expressions, or None.
+    """
+    attrs = []
+    while True:
+        if isinstance(node, nodes.Call):
+            node = node.node
+        elif isinstance(node, nodes.Getattr):
+            attrs.append(node.attr)
+            node = node.node
+        elif isinstance(node, nodes.Getitem) and isinstance(
+            node.arg, nodes.Const
+        ):
+            if not isinstance(node.arg.value, str):
+                return None
+            attrs.append(node.arg.value)
+            node = node.node
+        elif isinstance(node, nodes.Name):
+            return node.name, attrs[::-1]
+        else:
+            return None
+
+
+def plan(model, roots, templates):
+    """
+    Plans the relations of `model` to fetch to render the parsed
+    `templates`. `roots` maps the names of the context to their attribute
+    chain from the model, eg. {'user': [], 'email': ['user', 'email']}.
+    """
+    result = Plan()
+    roots = dict(roots)
+
+    def add(attrs):
+        path, many, rest = resolve(model, attrs)
+        if path:
+            result.add(path, many)
+        return path, rest
+
+    def visit(node):
+        """
+        Adds the relations of an expression. Returns its attribute chain from
+        the model if it evaluates to related objects.
+        """
+        chain = attribute_chain(node)
+        if chain is None or chain[0] not in roots:
+            return None
+        name, attrs = chain
+        attrs = roots[name] + attrs
+        path, rest = add(attrs)
+        # iterating over user.groups.all() yields groups
+        if rest in ([], ['all']):
+            return attrs[: len(attrs) - len(rest)]
+        return None
+
+    for attrs in roots.values():
+        add(attrs)
+
+    for ast in templates:
+        # loop variables and assignments of relations become roots
+        for node in ast.find_all((nodes.For, nodes.Assign)):
+            value = node.iter if isinstance(node, nodes.For) else node.node
+            attrs = visit(value)
+            if attrs is not None and isinstance(node.target, nodes.Name):
+                roots[node.target.name] = attrs
+        for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+            visit(node)
+    return result
@@ -0,0 +1,213 @@
+"""
+Pagination of query results for the previews of the editors.
+
+Results are paged by primary key (keyset pagination) with opaque cursors
+instead of page numbers, so that a page deep in the results costs the same
+as the first one:
+
+    rows, previous, next = window(queryset, cursor, size=10)
+"""
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+
+# The fields shown for each model, eg. {'auth.User': ['username', 'email']}.
+# Models not listed show all their columns.
+PREVIEW_FIELDS = getattr(settings, 'MASSMAILER_PREVIEW_FIELDS', {})
+# Number of rows of the query editor preview.
+PREVIEW_SIZE = getattr(settings, 'MASSMAILER_PREVIEW_SIZE', 10)
+MAX_PREVIEW_SIZE = 100
+# Number of rows counted before the counts of the previews are estimated.
+COUNT_ESTIMATE_LIMIT = getattr(
+    settings, 'MASSMAILER_COUNT_ESTIMATE_LIMIT', 1000
+)
+
+AFTER, BEFORE = 'after', 'before'
+CURSOR_SALT = 'massmailer.preview'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(direction, pk):
+    # as a string, for the primary keys that JSON cannot store (eg. UUIDs)
+    return signing.dumps([direction, str(pk)], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor, model):
+    """
+    Returns the (direction, pk) of a cursor on the rows of `model`, or
+    raises InvalidCursor.
+    """
+    try:
+        direction, pk = signing.loads(cursor, salt=CURSOR_SALT)
+        pk = model._meta.pk.to_python(pk)
+    except (signing.BadSignature, TypeError, ValueError, ValidationError):
+        raise InvalidCursor(cursor) from None
+    if direction not in (AFTER, BEFORE):
+        raise InvalidCursor(cursor)
+    return direction, pk
+
+
+def _pk(row):
+    return row['pk'] if isinstance(row, dict) else row.pk
+
+
+def window(queryset, cursor=None, size=1):
+    """
+    Returns the `size` rows of `queryset` after (or before) `cursor`, the
+    first ones without cursor, ordered by primary key. Returns (rows,
+    previous cursor, next cursor), the cursors being None on the first and
+    last pages.
+    """
+    direction, pk = (
+        decode_cursor(cursor, queryset.model) if cursor else (AFTER, None)
+    )
+    if direction == BEFORE:
+        rows = list(queryset.filter(pk__lt=pk).order_by('-pk')[: size + 1])
+        if rows:
+            more = len(rows) > size
+            rows = rows[:size][::-1]
+            previous = encode_cursor(BEFORE, _pk(rows[0])) if more else None
+            return rows, previous, encode_cursor(AFTER, _pk(rows[-1]))
+        # the rows before the cursor were deleted meanwhile
+        pk = None
+    if pk is not None:
+        queryset = queryset.filter(pk__gt=pk)
+    rows = list(queryset.order_by('pk')[: size + 1])
+    more = len(rows) > size
+    rows = rows[:size]
+    previous = next = None
+    if rows and pk is not None:
+        previous = encode_cursor(BEFORE, _pk(rows[0]))
+    if more:
+        next = encode_cursor(AFTER, _pk(rows[-1]))
+    return rows, previous, next
+
+
+def preview_fields(model):
+    """
+    Returns the names of the fields shown for `model`: its columns, then its
+    many-to-many fields, like Django's serializers.
+    """
+    names = PREVIEW_FIELDS.get(model._meta.label)
+    if names is None:
+        names = [
+            field.name
+            for field in model._meta.concrete_fields
+            if not field.primary_key
+        ]
+        names.extend(
+            field.name
+            for field in model._meta.many_to_many
+            if field.remote_field.through._meta.auto_created
+        )
+    return names
+
+
+def is_many_to_many(model, name):
+    try:
+        return model._meta.get_field(name).many_to_many
+    except FieldDoesNotExist:
+        return False
+
+
+def related_model(model, field):
+    """
+    Returns the model reached by following the single-valued relations of
+    `field` (with the field__subfield syntax) from `model`, or None.
+    """
+    try:
+        for name in field.split('__'):
+            f = model._meta.get_field(name)
+            if not (f.many_to_one or f.one_to_one):
+                return None
+            model = f.related_model
+    except FieldDoesNotExist:
+        return None
+    return model
+
+
+class Serializer:
+    """
+    Serializes the objects of a queryset, and the related objects of its
+    aliases, in the format of Django's JSON serializer. Their columns are read
+    from a single values() query, and their many-to-many fields, as lists of
+    primary keys, from one query per field for a whole page of rows.
+    """
+
+    def __init__(self, model, model_name, aliases):
+        self.model_name = model_name
+        # (name, path prefix of the columns, model)
+        self.objects = [(model_name, '', model)]
+        for alias, field in aliases:
+            related = related_model(model, field)
+            if related is not None:
+                self.objects.append((alias, field + '__', related))
+
+    @staticmethod
+    def fields(model):
+        """Returns the (columns, many-to-many fields) shown for `model`."""
+        columns, many = [], []
+        for field in preview_fields(model):
+            (many if is_many_to_many(model, field) else columns).append(field)
+        return columns, many
+
+    def columns(self):
+        columns = []
+        for name, prefix, model in self.objects:
+            columns.append(prefix + 'pk')
+            columns.extend(prefix + field for field in self.fields(model)[0])
+        return columns
+
+    def values(self, queryset):
+        return queryset.values(*self.columns())
+
+    def many_to_many(self, rows):
+        """
+        Returns the primary keys of the objects related to `rows` by the
+        many-to-many fields, as {(prefix, field): {pk: [related pks]}}.
+        """
+        related = {}
+        for name, prefix, model in self.objects:
+            many = self.fields(model)[1]
+            pks = {row[prefix + 'pk'] for row in rows} - {None}
+            if not many or not pks:
+                continue
+            for field in many:
+                values = related[prefix, field] = {}
+                pairs = (
+                    model._base_manager.filter(pk__in=pks)
+                    .values_list('pk', field)
+                    .order_by('pk', field)
+                )
+                for pk, value in pairs:
+                    target = values.setdefault(pk, [])
+                    if value is not None:
+                        target.append(value)
+        return related
+
+    def serialize_rows(self, rows):
+        related = self.many_to_many(rows)
+        return [self.serialize(row, related) for row in rows]
+
+    def serialize(self, row, related=None):
+        if related is None:
+            related = self.many_to_many([row])
+        result = {}
+        for name, prefix, model in self.objects:
+            pk = row[prefix + 'pk']
+            if pk is None:
+                continue  # eg. a null foreign key
+            columns, many = self.fields(model)
+            fields = {field: row[prefix + field] for field in columns}
+            for field in many:
+                fields[field] = related[prefix, field].get(pk, [])
+            result[name] = {
+                'model': model._meta.label_lower,
+                'pk': pk,
+                'fields': fields,
+            }
+        return result
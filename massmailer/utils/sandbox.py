@@ -1,8 +1,45 @@
+import types
+
+import jinja2
 import jinja2.sandbox
 
+from massmailer.utils.cache import LRUCache
+
 
 class SandboxedModelEnvironment(jinja2.sandbox.SandboxedEnvironment):
+    """
+    Sandboxed environment that also refuses to call the methods of models
+    that alter data. The safety decisions only depend on the type of the
+    objects and on the functions, so they are made once for each.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.safe_attributes = {}
+        # closures may be created on each render: keep a bounded number
+        self.safe_callables = LRUCache(maxsize=1024)
+
+    def is_safe_attribute(self, obj, attr, value):
+        key = (type(obj), attr)
+        try:
+            return self.safe_attributes[key]
+        except KeyError:
+            pass
+        safe = super().is_safe_attribute(obj, attr, value)
+        self.safe_attributes[key] = safe
+        return safe
+
     def is_safe_callable(self, obj):
+        # bound methods are created on each access, their function is not
+        func = getattr(obj, '__func__', obj)
+        if not isinstance(func, types.FunctionType):
+            return self.check_callable(obj)
+        return self.safe_callables.get_or_set(
+            func, lambda: self.check_callable(obj)
+        )
+
+    def check_callable(self, obj):
         if getattr(obj, 'alters_data', False):
             return False
         return super().is_safe_callable(obj)
+
@@ -0,0 +1,81 @@
+"""
+Fast rendering of templates that only substitute variables, eg.
+
+    Hello {{ user.first_name }}, your school is {{ school.name }}.
+
+Such templates are rendered by concatenating their literal text with the
+values of their variables, looked up as Jinja does (same sandbox checks,
+same undefined values and errors), instead of running the compiled template.
+"""
+
+from jinja2 import nodes
+from jinja2.runtime import missing
+from markupsafe import escape
+
+
+class SubstitutionTemplate:
+    def __init__(self, env, segments):
+        self.env = env
+        # literal strings, or (name, [attributes]) variables
+        self.segments = segments
+        self.convert = escape if env.autoescape else str
+        self.finalize = env.finalize
+
+    def lookup(self, context, name, attrs):
+        env = self.env
+        value = context.get(name, missing)
+        if value is missing:
+            value = env.globals.get(name, missing)
+        if value is missing:
+            value = env.undefined(name=name)
+        for attr in attrs:
+            value = env.getattr(value, attr)
+        return value
+
+    def render(self, context):
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            else:
+                name, attrs = segment
+                value = self.lookup(context, name, attrs)
+                if self.finalize is not None:
+                    value = self.finalize(value)
+                parts.append(self.convert(value))
+        return ''.join(parts)
+
+
+def variable(node):
+    """Returns (name, [attributes]) for `a.b.c` expressions, or None."""
+    attrs = []
+    while isinstance(node, nodes.Getattr):
+        attrs.append(node.attr)
+        node = node.node
+    if not isinstance(node, nodes.Name):
+        return None
+    return node.name, attrs[::-1]
+
+
+def compile_substitutions(env, ast):
+    """
+    Returns a SubstitutionTemplate rendering the parsed template `ast`, or
+    None if it does more than substituting variables.
+    """
+    if callable(env.autoescape):
+        return None
+    if hasattr(env.finalize, 'jinja_pass_arg'):
+        return None
+    segments = []
+    for output in ast.body:
+        if not isinstance(output, nodes.Output):
+            return None
+        for node in output.nodes:
+            if isinstance(node, nodes.TemplateData):
+                segments.append(node.data)
+                continue
+            segment = variable(node)
+            if segment is None:
+                return None
+            segments.append(segment)
+    return SubstitutionTemplate(env, segments)
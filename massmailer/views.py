@@ -1,7 +1,5 @@
-import bleach
-import json
 import inspect
-import markdown
+import logging
 import traceback
 import pyparsing
 
@@ -11,9 +9,7 @@ from django.contrib.auth.mixins import (
     PermissionRequiredMixin,
     UserPassesTestMixin,
 )
-from django.core import serializers
 from django.core.exceptions import FieldError, ObjectDoesNotExist
-from django.db import models
 from django.db import transaction
 from django.db.models import Count
 from django.http.response import JsonResponse, Http404
@@ -37,8 +33,24 @@ from reversion.views import RevisionMixin
 import massmailer.forms
 import massmailer.models
 import massmailer.tasks
-from massmailer.query_parser import QueryParser
-from massmailer.utils import JinjaEscapeExtension, get_attr_rec
+from massmailer.query_parser import default_registries
+from massmailer.utils import markdown_to_html
+from massmailer.utils.aliases import Aliases
+from massmailer.utils.db import (
+    QueryTimeout,
+    estimate_count,
+    sandboxed_queries,
+)
+from massmailer.utils.preview import (
+    COUNT_ESTIMATE_LIMIT,
+    MAX_PREVIEW_SIZE,
+    PREVIEW_SIZE,
+    InvalidCursor,
+    Serializer,
+    window,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class MailerAdminMixin(UserPassesTestMixin):
@@ -129,7 +141,7 @@ class TemplatePreviewView(PermissionRequiredMixin, MailerAdminMixin, View):
         html_enabled = request.POST.get('html_enabled') == 'true'
 
         query = massmailer.models.Query.objects.get(pk=request.POST['query'])
-        page = int(request.POST['page'])
+        cursor = request.POST.get('cursor') or None
 
         template = massmailer.models.Template()
         template.is_marketing = request.POST.get('is_marketing') == 'true'
@@ -139,45 +151,60 @@ class TemplatePreviewView(PermissionRequiredMixin, MailerAdminMixin, View):
 
         if html_enabled:
             if request.POST.get('use_markdown') == 'true':
-                md = markdown.Markdown(extensions=[JinjaEscapeExtension()])
-                html = data['html_template'] = md.convert(
-                    bleach.clean(template.plain_body)
+                html = data['html_template'] = markdown_to_html(
+                    template.plain_body
                 )
             else:
                 html = request.POST['html']
             template.html_body = html
 
-        results, user_qs = query.get_results()
-        qs = results.queryset
-        if template.is_marketing and not hasattr(
-            qs.model, 'get_unsubscribe_url'
-        ):
-            data['error'] = _(
-                'If this is a mailing the query model must have a get_unsubscribe_url method.'
-            )
-            return JsonResponse(data)
-        count = qs.count()
-        user_count = user_qs.count()
-        data['query'] = {
-            'count': count,
-            'user_count': user_count,
-            'page': min(count, page),
-        }
+        Query = massmailer.models.Query
         try:
-            object = qs[page]
-            context = {
-                alias: get_attr_rec(object, field)
-                for alias, field in results.aliases.items()
+            with sandboxed_queries():
+                results, user_qs = query.get_results()
+                qs = results.queryset
+                if template.is_marketing and not hasattr(
+                    qs.model, 'get_unsubscribe_url'
+                ):
+                    data['error'] = _(
+                        'If this is a mailing the query model must have a get_unsubscribe_url method.'
+                    )
+                    return JsonResponse(data)
+                aliases = Aliases(qs.model, results.aliases)
+                annotated = aliases.annotate(qs)
+                try:
+                    objects, previous, next = window(annotated, cursor)
+                except InvalidCursor:
+                    objects, previous, next = window(annotated)
+            data['query'] = {
+                'count': Query.count(
+                    query.query, qs, 'recipients', sandboxed=True
+                ),
+                'user_count': Query.count(
+                    query.query, user_qs, sandboxed=True
+                ),
+                'previous': previous,
+                'next': next,
             }
-            context[results.model_name] = object
-            data['render'] = template.full_preview(context)
-            data['render']['header'] = ''
-            if template.is_marketing:
-                data['render']['header'] = "List-Unsubscribe: " + getattr(
-                    object, 'get_unsubscribe_url'
-                )
-        except IndexError:
-            data['render'] = ''
+            try:
+                object = objects[0]
+                # the template can query the database too
+                with sandboxed_queries():
+                    context = aliases.context(object)
+                    context[results.model_name] = object
+                    data['render'] = template.full_preview(context)
+                data['render']['header'] = ''
+                if template.is_marketing:
+                    data['render']['header'] = (
+                        "List-Unsubscribe: "
+                        + getattr(object, 'get_unsubscribe_url')
+                    )
+            except IndexError:
+                data['render'] = ''
+        except QueryTimeout as e:
+            data['error'] = _(
+                "The query was cancelled after %(timeout)s seconds."
+            ) % {'timeout': e.timeout}
         return JsonResponse(data)
 
 
@@ -192,7 +219,7 @@ class QueryMixin(MailerAdminMixin, RevisionMixin):
         return sorted(
             (
                 {'name': name, 'members': [m.name for m in enum]}
-                for name, enum in QueryParser().available_enums.items()
+                for name, enum in default_registries().enums.items()
             ),
             key=lambda e: e['name'].lower(),
         )
@@ -205,7 +232,7 @@ class QueryMixin(MailerAdminMixin, RevisionMixin):
                 'doc': inspect.getdoc(func),
                 'signature': inspect.signature(func),
             }
-            for name, func in QueryParser().available_funcs.items()
+            for name, func in default_registries().funcs.items()
         ]
 
     @cached_property
@@ -249,6 +276,7 @@ class QueryMixin(MailerAdminMixin, RevisionMixin):
         context['available_funcs'] = self.available_funcs
         context['available_models'] = self.available_models
         context['user_model'] = get_user_model().__name__
+        context['preview_size'] = PREVIEW_SIZE
         return context
 
 
@@ -279,53 +307,95 @@ class QueryPreviewView(PermissionRequiredMixin, MailerAdminMixin, View):
     permission_required = 'massmailer.view_query'
 
     @staticmethod
-    def serialize(obj):
-        if obj is None:
-            return None
-        if not isinstance(obj, models.Model):
-            return None
-        return json.loads(
-            serializers.get_serializer('json')().serialize([obj])
-        )[0]
+    def counts(query, qs, user_qs):
+        """
+        Returns the numbers of recipients and users of the `query` text, and
+        whether they are approximate. The counts that are not cached are
+        estimated, and counted exactly in the background for QueryCountView.
+        """
+        Query = massmailer.models.Query
+        counts, approximate = [], False
+        for queryset, counted in ((qs, 'recipients'), (user_qs, 'users')):
+            count = Query.cached_count(query, counted)
+            if count is None:
+                with sandboxed_queries():
+                    count, exact = estimate_count(
+                        queryset, COUNT_ESTIMATE_LIMIT
+                    )
+                if exact:
+                    Query.cache_count(query, counted, count)
+                else:
+                    approximate = True
+            counts.append(count)
+        if approximate:
+            massmailer.tasks.count_query_later(query)
+        return counts, approximate
 
     def post(self, request, *args, **kwargs):
         query = request.POST['query']
-        page = int(request.POST['page'])
+        cursor = request.POST.get('cursor') or None
         try:
-            # run the query
-            result, user_qs = massmailer.models.Query.execute(query)
-            qs = result.queryset
-            count = qs.count()
-            user_count = user_qs.count()
-            instance = None
-            if 0 <= page < count:
-                obj = qs[page]
-                instance = {result.model_name: self.serialize(obj)}
-                for name, field in result.aliases.items():
-                    serialized = self.serialize(get_attr_rec(obj, field))
-                    if serialized:
-                        instance[name] = serialized
-
+            size = int(request.POST.get('size', PREVIEW_SIZE))
+            size = max(1, min(size, MAX_PREVIEW_SIZE))
+            with sandboxed_queries():
+                # run the query
+                result, user_qs = massmailer.models.Query.execute(query)
+                qs = result.queryset
+                # aliases selected in SQL are never model instances
+                aliases = Aliases(qs.model, result.aliases)
+                serializer = Serializer(
+                    qs.model, result.model_name, aliases.walked()
+                )
+                rows, previous, next = window(
+                    serializer.values(qs), cursor, size
+                )
+            (count, user_count), approximate = self.counts(query, qs, user_qs)
             data = {
                 'count': count,
                 'user_count': user_count,
+                'approximate': approximate,
                 'model': qs.model._meta.label,
                 'model_name': result.model_name,
                 'aliases': list(result.aliases.items()),
                 'query': str(qs.query),
-                'result': instance,
+                'results': serializer.serialize_rows(rows),
+                'previous': previous,
+                'next': next,
             }
         except Exception as e:
             if isinstance(e, (massmailer.query_parser.ParseError, FieldError)):
                 error = str(e)
             elif isinstance(e, pyparsing.ParseException):
                 error = _("Syntax error at position %(pos)s.") % {'pos': e.loc}
+            elif isinstance(e, InvalidCursor):
+                error = _("Invalid page, please reload the preview.")
+            elif isinstance(e, QueryTimeout):
+                error = _(
+                    "The query was cancelled after %(timeout)s seconds."
+                ) % {'timeout': e.timeout}
             else:
                 error = traceback.format_exc(limit=2)
             data = {'error': error}
         return JsonResponse(data)
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class QueryCountView(PermissionRequiredMixin, MailerAdminMixin, View):
+    """The exact counts of a query text, once QueryPreviewView made them."""
+
+    permission_required = 'massmailer.view_query'
+
+    def post(self, request, *args, **kwargs):
+        query = request.POST['query']
+        Query = massmailer.models.Query
+        return JsonResponse(
+            {
+                'count': Query.cached_count(query, 'recipients'),
+                'user_count': Query.cached_count(query, 'users'),
+            }
+        )
+
+
 class BatchListView(PermissionRequiredMixin, MailerAdminMixin, ListView):
     model = massmailer.models.Batch
     template_name = 'massmailer/batch-list.html'
@@ -344,21 +414,29 @@ class BatchCreateView(PermissionRequiredMixin, MailerAdminMixin, CreateView):
         return reverse('massmailer:batch:detail', args=[self.object.pk])
 
     def form_valid(self, form):
-        with transaction.atomic():
-            # create the batch
-            batch = form.save(commit=False)
-            batch.initiator = self.request.user
-            batch.save()
-
-            emails = list(batch.build_emails())
-            # create the batch emails
-            massmailer.models.BatchEmail.objects.bulk_create(emails)
-
-        # create the tasks
-        for email in emails:
-            email.send_task()
+        # create the batch
+        self.object = batch = form.save(commit=False)
+        batch.initiator = self.request.user
+        batch.build_state = massmailer.models.BuildState.building.value
+        if batch.render_at_send:
+            batch.freeze()
+        batch.save()
+
+        # build the batch emails and their tasks in the background
+        transaction.on_commit(lambda: self.schedule_build(batch))
+
+        # the batch must not be saved again, as the build tasks update it
+        return super(ModelFormMixin, self).form_valid(form)
 
-        return super().form_valid(form)
+    def schedule_build(self, batch):
+        try:
+            massmailer.tasks.build_batch.delay(batch.pk)
+        except Exception:
+            # the batch would otherwise be shown as building forever
+            logger.exception("Could not schedule the build of %s", batch)
+            batch.update_build(
+                build_state=massmailer.models.BuildState.failed.value
+            )
 
     def get_object(self):
         return None  # the batch isn't in the db yet
@@ -377,14 +455,14 @@ class BatchDetailView(PermissionRequiredMixin, MailerAdminMixin, ListView):
 
     @cached_property
     def batch(self):
-        return (
-            massmailer.models.Batch.objects.prefetch_related('emails')
-            .annotate(email_count=Count('emails'))
-            .get(pk=self.batch_id)
-        )
+        return massmailer.models.Batch.objects.annotate(
+            email_count=Count('emails')
+        ).get(pk=self.batch_id)
 
     def get_queryset(self):
-        return self.batch.emails.all()
+        return self.batch.emails.select_related('subject_content').defer(
+            'body_text', 'html_body_text'
+        )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -392,6 +470,25 @@ class BatchDetailView(PermissionRequiredMixin, MailerAdminMixin, ListView):
         return context
 
 
+class BatchProgressView(PermissionRequiredMixin, MailerAdminMixin, View):
+    permission_required = 'massmailer.view_batch'
+
+    def get(self, request, *args, **kwargs):
+        try:
+            batch = massmailer.models.Batch._base_manager.get(
+                pk=self.kwargs['id']
+            )
+        except ObjectDoesNotExist:
+            raise Http404()
+        return JsonResponse(
+            {
+                'state': batch.build_state_display,
+                'progress': batch.build_progress,
+                'total': batch.build_total,
+            }
+        )
+
+
 class BatchRetryView(PermissionRequiredMixin, MailerAdminMixin, UpdateView):
     model = massmailer.models.Batch
     pk_url_kwarg = 'id'
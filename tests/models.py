@@ -1,4 +1,5 @@
 import enum
+import uuid
 
 from django.db import models
 
@@ -20,3 +21,7 @@ class SomeChild(models.Model):
         SomeModel, related_name='children', on_delete=models.CASCADE
     )
     child_field = models.CharField(max_length=128)
+
+
+class SomeUUIDModel(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
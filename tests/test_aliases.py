@@ -0,0 +1,42 @@
+from django.test import TestCase
+
+from massmailer.utils.aliases import Aliases, is_scalar_path
+from tests.models import SomeChild, SomeModel
+
+
+class AliasesTestCase(TestCase):
+    def setUp(self):
+        for i in range(3):
+            parent = SomeModel.objects.create(
+                text_field='parent{}'.format(i), int_field=i
+            )
+            SomeChild.objects.create(parent=parent, child_field=str(i))
+
+    def test_scalar_paths(self):
+        self.assertTrue(is_scalar_path(SomeChild, 'parent__text_field'))
+        self.assertTrue(is_scalar_path(SomeChild, 'child_field'))
+        self.assertFalse(is_scalar_path(SomeChild, 'parent'))
+        self.assertFalse(is_scalar_path(SomeChild, 'parent__garbage'))
+        self.assertFalse(is_scalar_path(SomeModel, 'children__child_field'))
+
+    def test_context(self):
+        aliases = Aliases(
+            SomeChild,
+            {
+                'name': 'parent__text_field',
+                'field': 'child_field',
+                'parent': 'parent',
+            },
+        )
+        self.assertListEqual(
+            aliases.walked(), [('field', 'child_field'), ('parent', 'parent')]
+        )
+        queryset = aliases.annotate(SomeChild.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            names = [aliases.value(child, 'name') for child in queryset]
+        self.assertListEqual(names, ['parent0', 'parent1', 'parent2'])
+
+        child = queryset.first()
+        context = aliases.context(child)
+        self.assertEqual(context['parent'], SomeModel.objects.first())
+        self.assertEqual(context['name'], 'parent0')
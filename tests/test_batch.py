@@ -0,0 +1,435 @@
+import celery
+import concurrent.futures
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+
+from massmailer.forms import CreateBatchForm
+
+from massmailer.models import (
+    Batch,
+    BatchEmail,
+    BatchEmailContent,
+    BuildState,
+    MailState,
+    Query,
+    Template,
+)
+from massmailer.render import get_executor
+from massmailer.tasks import build_batch, send_email
+from massmailer.views import BatchCreateView, BatchDetailView
+from massmailer.utils.db import COMPRESSED_MARKER, SQLiteStatementLimit
+
+
+class SynchronousExecutor(concurrent.futures.Executor):
+    def __init__(self, max_workers=None):
+        self.submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+def create_batch(query="User", **template_kwargs):
+    template = Template.objects.create(
+        name="Hello",
+        language="en-US",
+        subject="Hello {{ user.username }}",
+        plain_body="Hi {{ user.username }}!",
+        **template_kwargs
+    )
+    query = Query.objects.create(name="Everyone", query=query)
+    return Batch.objects.create(template=template, query=query)
+
+
+class BatchTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        for i in range(5):
+            User.objects.create_user(
+                'user{}'.format(i), email='user{}@example.org'.format(i)
+            )
+
+    def run_eagerly(self, task, *args):
+        conf = celery.current_app.conf
+        saved = conf.task_always_eager, conf.task_eager_propagates
+        conf.task_always_eager = conf.task_eager_propagates = True
+        try:
+            task.delay(*args)
+        finally:
+            conf.task_always_eager, conf.task_eager_propagates = saved
+
+    def test_build_emails(self):
+        batch = create_batch()
+        emails = list(batch.build_emails(chunk_size=2))
+        self.assertEqual(len(emails), 5)
+        self.assertEqual(emails[0].to, 'user0@example.org')
+        self.assertEqual(emails[0].subject, 'Hello user0')
+        self.assertEqual(emails[0].body, 'Hi user0!')
+        self.assertEqual(emails[0].html_body, '')
+
+    def test_create_emails_by_chunks(self):
+        batch = create_batch()
+        chunks = list(batch.create_emails(chunk_size=2, batch_size=1))
+        self.assertListEqual([len(emails) for emails in chunks], [2, 2, 1])
+        self.assertEqual(BatchEmail.objects.filter(batch=batch).count(), 5)
+
+    def test_contents_deduplicated(self):
+        html_body = "<p>Same for everyone</p>"
+        batch = create_batch(html_body=html_body)
+        list(batch.create_emails(chunk_size=2))
+        list(create_batch(html_body=html_body).create_emails())
+
+        # a single HTML body, the subjects and bodies are all different
+        self.assertEqual(BatchEmailContent.objects.count(), 1)
+        email = BatchEmail.objects.filter(batch=batch).first()
+        self.assertEqual(email.subject, 'Hello user0')
+        self.assertEqual(email.body, 'Hi user0!')
+        self.assertEqual(email.html_body, '<p>Same for everyone</p>')
+        self.assertEqual(email.subject_text, 'Hello user0')
+        self.assertEqual(email.html_body_text, '')
+        # alone in its chunk
+        email = BatchEmail.objects.get(batch=batch, to='user4@example.org')
+        self.assertEqual(email.html_body_text, '<p>Same for everyone</p>')
+        self.assertFalse(BatchEmailContent.objects.unreferenced().exists())
+
+        BatchEmail.objects.filter(batch=batch).delete()
+        self.assertEqual(BatchEmailContent.objects.unreferenced().count(), 0)
+        BatchEmail.objects.all().delete()
+        self.assertEqual(BatchEmailContent.objects.unreferenced().count(), 1)
+
+    def test_content_filter(self):
+        batch = create_batch(html_body="<p>Same for everyone</p>")
+        list(batch.create_emails())
+        list(create_batch().create_emails())
+
+        def emails(field, value):
+            return BatchEmail.objects.filter(
+                BatchEmail.content_filter(field, value)
+            )
+
+        # stored in the email
+        self.assertListEqual(
+            [e.to for e in emails('subject', 'Hello user1')],
+            ['user1@example.org'] * 2,
+        )
+        # shared
+        self.assertEqual(
+            emails('html_body', '<p>Same for everyone</p>').count(), 5
+        )
+        self.assertEqual(emails('html_body', '').count(), 5)
+        self.assertFalse(emails('body', 'Hi!').exists())
+
+    def raw_html_bodies(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT html_body FROM {}'.format(BatchEmail._meta.db_table)
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_bodies_compressed(self):
+        html_body = "<p>{{ user.username }}</p>" + "<p>Hello!</p>" * 100
+        batch = create_batch(html_body=html_body)
+        BatchEmail.objects.bulk_create(batch.build_emails())
+
+        raw = self.raw_html_bodies()
+        self.assertTrue(all(b.startswith(COMPRESSED_MARKER) for b in raw))
+        self.assertLess(len(raw[0]), 1000)
+        email = BatchEmail.objects.get(to='user0@example.org')
+        self.assertTrue(email.html_body.startswith('<p>user0</p><p>Hello!'))
+        message = email.build_email()
+        self.assertEqual(message.alternatives[0][0][:12], '<p>user0</p>')
+
+    def test_compress_command(self):
+        batch = create_batch()
+        BatchEmail.objects.bulk_create(batch.build_emails())
+        html_body = "<p>Hello!</p>" * 100
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE {} SET html_body = %s'.format(
+                    BatchEmail._meta.db_table
+                ),
+                [html_body],
+            )
+        email = BatchEmail.objects.first()
+        self.assertEqual(email.html_body, html_body)
+
+        call_command('compress_email_bodies', batch_size=2, stdout=StringIO())
+        raw = self.raw_html_bodies()
+        self.assertEqual(len(raw), 5)
+        self.assertTrue(all(b.startswith(COMPRESSED_MARKER) for b in raw))
+        email = BatchEmail.objects.get(pk=email.pk)
+        self.assertEqual(email.html_body, html_body)
+
+    def test_prune_command(self):
+        batch = create_batch(html_body="<p>Same for everyone</p>")
+        list(batch.create_emails())
+        list(create_batch(html_body="<p>Kept</p>").create_emails())
+        BatchEmail.objects.filter(batch=batch).delete()
+        self.assertEqual(BatchEmailContent.objects.count(), 2)
+
+        # without table locks, contents are kept while batches are built
+        other = create_batch()
+        other.update_build(build_state=BuildState.building.value)
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            out = StringIO()
+            call_command('prune_email_contents', stdout=out)
+        self.assertIn("being built", out.getvalue())
+        self.assertEqual(BatchEmailContent.objects.count(), 2)
+
+        out = StringIO()
+        call_command('prune_email_contents', stdout=out)
+        self.assertEqual(out.getvalue(), "Deleted 1 e-mail contents.\n")
+        self.assertEqual(BatchEmailContent.objects.count(), 1)
+
+    def test_partitions(self):
+        batch = create_batch()
+        partitions = list(batch.partitions(size=2))
+        self.assertEqual(len(partitions), 3)
+        self.assertListEqual(
+            [count for first_pk, last_pk, count in partitions], [2, 2, 1]
+        )
+        emails = list(batch.build_emails(pk_range=partitions[1][:2]))
+        self.assertListEqual(
+            [email.to for email in emails],
+            ['user2@example.org', 'user3@example.org'],
+        )
+
+    def test_build_batch_task(self):
+        batch = create_batch()
+        batch.update_build(build_state=BuildState.building.value)
+        self.run_eagerly(build_batch, batch.pk)
+
+        batch = Batch._base_manager.get(pk=batch.pk)
+        self.assertEqual(batch.build_state, BuildState.ready.value)
+        self.assertEqual(batch.build_progress, 5)
+        self.assertEqual(batch.build_total, 5)
+        self.assertEqual(batch.emails.count(), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            batch.emails.filter(state=MailState.sent.value).count(), 5
+        )
+
+    def test_build_batch_task_failure(self):
+        batch = create_batch(query="User alias email = .garbage")
+        batch.update_build(build_state=BuildState.building.value)
+        with self.assertRaises(Exception):
+            self.run_eagerly(build_batch, batch.pk)
+
+        batch = Batch._base_manager.get(pk=batch.pk)
+        self.assertEqual(batch.build_state, BuildState.failed.value)
+
+    def test_build_empty_batch(self):
+        batch = create_batch(query="User .username = 'nobody'")
+        batch.update_build(build_state=BuildState.building.value)
+        self.run_eagerly(build_batch, batch.pk)
+
+        batch = Batch._base_manager.get(pk=batch.pk)
+        self.assertEqual(batch.build_state, BuildState.ready.value)
+        self.assertEqual(batch.build_total, 0)
+        self.assertEqual(batch.emails.count(), 0)
+
+    @override_settings(DEBUG=True)
+    def test_create_batch_schedule_failure(self):
+        batch = create_batch()
+        request = RequestFactory().post(
+            '/',
+            {
+                'name': 'Batch',
+                'template': batch.template.pk,
+                'query': batch.query.pk,
+            },
+        )
+        request.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.org', 'password'
+        )
+        with mock.patch(
+            'django.db.transaction.on_commit', lambda func: func()
+        ), mock.patch.object(
+            build_batch, 'delay', side_effect=ConnectionError
+        ), self.assertLogs(
+            'massmailer.views'
+        ):
+            response = BatchCreateView.as_view()(request)
+        self.assertEqual(response.status_code, 302)
+        created = Batch._base_manager.get(name='Batch')
+        self.assertEqual(created.build_state, BuildState.failed.value)
+
+    def test_render_at_send(self):
+        batch = create_batch()
+        batch.render_at_send = True
+        batch.freeze()
+        batch.save()
+        # edits after the batch was created are not sent
+        batch.template.subject = "Changed"
+        batch.template.save()
+
+        emails = [e for es in batch.create_emails() for e in es]
+        self.assertEqual(emails[0].to, 'user0@example.org')
+        self.assertEqual(emails[0].subject, '')
+        self.assertEqual(emails[0].body, '')
+
+        email = BatchEmail.objects.get(pk=emails[0].pk)
+        message = email.build_email()
+        self.assertEqual(message.subject, 'Hello user0')
+        self.assertEqual(message.body, 'Hi user0!')
+        self.assertListEqual(message.to, ['user0@example.org'])
+
+    def test_render_at_send_deleted_recipient(self):
+        batch = create_batch()
+        batch.render_at_send = True
+        batch.freeze()
+        batch.save()
+        list(batch.create_emails())
+        email = BatchEmail.objects.get(to='user0@example.org')
+        get_user_model().objects.filter(username='user0').delete()
+
+        with self.assertRaises(celery.exceptions.Retry):
+            self.run_eagerly(send_email, email.pk)
+        # left to be retried, instead of being stuck in the sending state
+        email.refresh_from_db()
+        self.assertEqual(email.state, MailState.pending.value)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_create_batch_form_counts_once(self):
+        batch = create_batch()
+        data = {
+            'name': 'Batch',
+            'template': batch.template.pk,
+            'query': batch.query.pk,
+        }
+        with CaptureQueriesContext(connection) as queries:
+            form = CreateBatchForm(data=data)
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.recipient_count, 5)
+        counts = [q for q in queries if 'COUNT(' in q['sql']]
+        self.assertEqual(len(counts), 1)
+
+        # the count is reused by the confirmation step, until the query is
+        # saved again
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(CreateBatchForm(data=data).is_valid())
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+        get_user_model().objects.create_user('user5')
+        self.assertEqual(CreateBatchForm(data=data).recipient_count, 5)
+        batch.query.save()
+        self.assertEqual(CreateBatchForm(data=data).recipient_count, 6)
+
+    def test_batch_detail_view(self):
+        batch = create_batch()
+        list(batch.create_emails())
+        request = RequestFactory().get('/')
+        request.user = get_user_model().objects.create_superuser(
+            'admin', 'admin@example.org', 'password'
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = BatchDetailView.as_view()(request, id=batch.pk)
+            response.render()
+        # the bodies of the emails are not loaded
+        body = '"massmailer_batchemail"."body"'
+        self.assertFalse([q for q in queries if body in q['sql']])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Hello user4')
+
+    def test_create_batch_form_timeout(self):
+        batch = create_batch()
+        data = {
+            'name': 'Batch',
+            'template': batch.template.pk,
+            'query': batch.query.pk,
+        }
+        with mock.patch.multiple(
+            SQLiteStatementLimit,
+            PROGRESS_STEPS=1,
+            start=lambda self: setattr(self, 'deadline', 0),
+        ), self.assertLogs('massmailer.utils.db'):
+            form = CreateBatchForm(data=data)
+            self.assertFalse(form.is_valid())
+        self.assertEqual(
+            form.non_field_errors(),
+            ["The query was cancelled after 10 seconds."],
+        )
+
+
+def email_contents(emails):
+    return [(email.to, email.subject, email.body) for email in emails]
+
+
+class ParallelRenderTestCase(TransactionTestCase):
+    def setUp(self):
+        User = get_user_model()
+        for i in range(7):
+            User.objects.create_user(
+                'user{}'.format(i), email='user{}@example.org'.format(i)
+            )
+
+    @override_settings(
+        MASSMAILER_RENDER_EXECUTOR='tests.test_batch.SynchronousExecutor',
+        MASSMAILER_PARALLEL_RENDER_THRESHOLD=5,
+    )
+    def test_parallel_path_matches_serial(self):
+        batch = create_batch()
+        serial = email_contents(batch.build_emails())
+        chunks = list(batch.create_emails(chunk_size=3))
+        self.assertListEqual([len(emails) for emails in chunks], [3, 3, 1])
+        emails = [email for emails in chunks for email in emails]
+        self.assertListEqual(email_contents(emails), serial)
+        self.assertTrue(all(email.batch is batch for email in emails))
+
+    @override_settings(
+        MASSMAILER_RENDER_EXECUTOR='thread',
+        MASSMAILER_RENDER_WORKERS=3,
+        MASSMAILER_PARALLEL_RENDER_THRESHOLD=5,
+    )
+    def test_thread_pool_ordering(self):
+        batch = create_batch()
+        serial = email_contents(batch.build_emails())
+        emails = [e for es in batch.create_emails(chunk_size=2) for e in es]
+        self.assertListEqual(email_contents(emails), serial)
+        self.assertEqual(BatchEmail.objects.filter(batch=batch).count(), 7)
+
+    @override_settings(
+        MASSMAILER_RENDER_EXECUTOR='process',
+        MASSMAILER_RENDER_WORKERS=2,
+        MASSMAILER_PARALLEL_RENDER_THRESHOLD=5,
+    )
+    def test_process_pool(self):
+        batch = create_batch()
+        serial = email_contents(batch.build_emails())
+        emails = [e for es in batch.create_emails(chunk_size=2) for e in es]
+        self.assertListEqual(email_contents(emails), serial)
+        # the connection of the parent is still usable
+        self.assertEqual(BatchEmail.objects.filter(batch=batch).count(), 7)
+
+    @override_settings(MASSMAILER_RENDER_EXECUTOR='process')
+    def test_process_pool_in_daemonic_process(self):
+        process = mock.Mock(daemon=True)
+        with mock.patch(
+            'multiprocessing.current_process', return_value=process
+        ), self.assertLogs('massmailer.render'):
+            executor = get_executor()
+        self.assertIsInstance(executor, concurrent.futures.ThreadPoolExecutor)
+        executor.shutdown()
+
+    @override_settings(
+        MASSMAILER_RENDER_EXECUTOR='tests.test_batch.SynchronousExecutor',
+        MASSMAILER_PARALLEL_RENDER_THRESHOLD=100,
+    )
+    def test_small_batches_rendered_serially(self):
+        batch = create_batch()
+        with mock.patch('massmailer.render.render_parallel') as parallel:
+            list(batch.create_emails(chunk_size=3))
+        parallel.assert_not_called()
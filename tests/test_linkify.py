@@ -0,0 +1,96 @@
+import bleach
+
+from django.test import SimpleTestCase
+
+from massmailer.models import Template, TemplateItem
+from massmailer.utils import linkify
+
+SOURCES = [
+    "<p>Hi {{ v }}, see https://example.org/page?u={{ v }}</p>",
+    "<p>{{ v }}.</p><p>Visit www.example.com today, {{ v }}!</p>",
+    '<a href="https://x.org/{{ v }}">link {{ v }}</a> {{ v }}{{ v }}',
+    '<a href="{{ v }}">{{ v }}</a>',
+    "<ul>{% for i in range(3) %}<li>{{ v }} {{ i }}</li>{% endfor %}</ul>",
+    "{% if v %}<b>{{ v }}</b>{% else %}none{% endif %} example.{{ v }}",
+    "<table>{{ v }}<tr><td>{{ v }}</td></tr></table>",
+    "<!-- {{ v }} --><p title='{{ v }}'>&amp; {{ v }} &copy; &</p>",
+    "www.{{ v }}.org and {{ v }}@example.org (see {{ v }})",
+    "Dear {{ v }},\r\n<br/>Bye<custom>{{ v }}</custom>",
+    "{% filter upper %}{{ v }} example.com{% endfilter %}",
+    "\ufdd00\ufdd1 {{ v }}",
+    # unquoted attributes, quoted by bleach
+    "<img alt={{ v }}><p title=x{{ v }} class={{ v }}>{{ v }}</p>",
+    "<p title=it's{{ v }} class='{{ v }}'>{{ v }}</p>",
+]
+
+VALUES = [
+    "",
+    "Ada",
+    "O'Brien",
+    "a & b",
+    "<b>bold</b>",
+    "example.com",
+    "https://example.org",
+    "mailto:a@example.org",
+    "a\rb",
+    "\ufdd00\ufdd1",
+    "com",
+    "42",
+    "a b",
+    "a=b",
+    "a>b",
+]
+
+
+class LinkifyTestCase(SimpleTestCase):
+    def setUp(self):
+        linkify.SKELETONS.clear()
+
+    def test_same_output_as_bleach(self):
+        for source in SOURCES:
+            t = Template(language='en-US', html_body=source)
+            template = t.template(TemplateItem.html)
+            for value in VALUES:
+                with self.subTest(source=source, value=value):
+                    expected = bleach.linkify(
+                        template.render({'v': value, 'language': 'en-US'})
+                    )
+                    self.assertEqual(
+                        t.render(TemplateItem.html, {'v': value}), expected
+                    )
+
+    def test_skeleton_linkified_once(self):
+        t = Template(
+            language='en-US',
+            html_body='<p>Hello {{ v }}, see www.example.org.</p>',
+        )
+        for value in ["Ada", "Grace", "Alan"]:
+            self.assertEqual(
+                t.render(TemplateItem.html, {'v': value}),
+                '<p>Hello {}, see <a href="http://www.example.org" '
+                'rel="nofollow">www.example.org</a>.</p>'.format(value),
+            )
+        self.assertEqual(linkify.SKELETONS.misses, 1)
+        self.assertEqual(linkify.SKELETONS.hits, 2)
+
+    def test_unsafe_positions(self):
+        with linkify.placeholders() as values:
+            Template(
+                language='en-US', html_body="http://example.org/{{ v }}"
+            ).template(TemplateItem.html).render(v='x', language='en-US')
+        self.assertListEqual(values, ['x'])
+        skeleton = 'http://example.org/\ufdd00\ufdd1'
+        self.assertIsNone(linkify.Skeleton.compile(skeleton, 1))
+        self.assertIs(linkify.Skeleton.compile(skeleton, 2), False)
+
+    def test_unquoted_attributes(self):
+        skeleton = '<img alt=\ufdd00\ufdd1 title="\ufdd01\ufdd1">'
+        compiled = linkify.Skeleton.compile(skeleton, 2)
+        self.assertEqual(
+            compiled.positions, {0: linkify.UNQUOTED, 1: linkify.UNQUOTED}
+        )
+        self.assertEqual(
+            compiled.substitute(['Ada', 'Grace']),
+            '<img alt="Ada" title="Grace">',
+        )
+        self.assertIsNone(compiled.substitute(['Ada Lovelace', 'Grace']))
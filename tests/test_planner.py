@@ -0,0 +1,80 @@
+import jinja2
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.test import TestCase
+
+from massmailer.models import Batch, Query, Template
+from massmailer.utils import planner
+from tests.models import SomeChild, SomeModel
+
+
+def plan(model, source, roots):
+    ast = jinja2.Environment().parse(source)
+    result = planner.plan(model, roots, [ast])
+    return result.select_related, result.prefetch_related
+
+
+class PlannerTestCase(TestCase):
+    def test_forward_relations(self):
+        select, prefetch = plan(
+            SomeChild,
+            "{{ child.parent.text_field }} {{ child['parent'].int_field }}",
+            {'child': []},
+        )
+        self.assertSetEqual(select, {'parent'})
+        self.assertSetEqual(prefetch, set())
+
+    def test_reverse_relations(self):
+        select, prefetch = plan(
+            SomeModel,
+            "{% for c in obj.children.all() %}"
+            "{{ c.parent.children.count() }}{% endfor %}",
+            {'obj': []},
+        )
+        self.assertSetEqual(select, set())
+        self.assertSetEqual(prefetch, {'children__parent__children'})
+
+    def test_aliases(self):
+        select, prefetch = plan(
+            SomeChild,
+            "{% set p = child.parent %}{{ p.text_field }} {{ name }}",
+            {'child': [], 'name': ['parent', 'text_field']},
+        )
+        self.assertSetEqual(select, {'parent'})
+
+    def test_unrelated_chains(self):
+        select, prefetch = plan(
+            SomeChild,
+            "{{ child.child_field.upper() }} {{ other.parent }}"
+            "{% set f = child.child_field %}{{ f.parent }}",
+            {'child': []},
+        )
+        self.assertSetEqual(select, set())
+        self.assertSetEqual(prefetch, set())
+
+
+class BatchPlanTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        groups = [Group.objects.create(name=str(i)) for i in range(3)]
+        for i in range(10):
+            user = User.objects.create_user(
+                'user{}'.format(i), email='user{}@example.org'.format(i)
+            )
+            user.groups.set(groups[: i % 3])
+
+    def test_queries_per_chunk(self):
+        template = Template.objects.create(
+            name="Groups",
+            language="en-US",
+            subject="Hello {{ user.username }}",
+            plain_body="{% for group in user.groups.all() %}"
+            "{{ group.name }} {% endfor %}",
+        )
+        query = Query.objects.create(name="Everyone", query="User")
+        batch = Batch.objects.create(template=template, query=query)
+        # 1 query for the users, and 1 for the groups of each chunk
+        with self.assertNumQueries(3):
+            emails = list(batch.build_emails(chunk_size=5))
+        self.assertEqual(emails[2].body, '0 1 ')
@@ -0,0 +1,357 @@
+import json
+from unittest import mock
+
+import celery
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.test import RequestFactory, TestCase
+
+from massmailer.models import Query, Template
+from massmailer.signals import query_timed_out
+from massmailer.tasks import count_query, count_query_later
+from massmailer.utils.db import (
+    MySQLStatementLimit,
+    PostgreSQLStatementLimit,
+    QueryTimeout,
+    SQLiteStatementLimit,
+    estimate_count,
+    sandboxed_queries,
+)
+from massmailer.utils.preview import (
+    InvalidCursor,
+    Serializer,
+    decode_cursor,
+    window,
+)
+from massmailer.views import (
+    QueryCountView,
+    QueryPreviewView,
+    TemplatePreviewView,
+)
+from tests.models import SomeChild, SomeModel, SomeUUIDModel
+
+
+class WindowTestCase(TestCase):
+    def setUp(self):
+        self.pks = [
+            SomeModel.objects.create(text_field=str(i), int_field=i).pk
+            for i in range(7)
+        ]
+
+    def pages(self, size):
+        qs = SomeModel.objects.all()
+        rows, previous, next = window(qs, size=size)
+        pages = [[row.pk for row in rows]]
+        self.assertIsNone(previous)
+        while next is not None:
+            rows, previous, next = window(qs, next, size)
+            pages.append([row.pk for row in rows])
+            self.assertIsNotNone(previous)
+        # and back to the first page
+        while previous is not None:
+            rows, previous, next = window(qs, previous, size)
+            pages.append([row.pk for row in rows])
+        return pages
+
+    def test_pages(self):
+        pks = self.pks
+        self.assertEqual(
+            self.pages(3),
+            [pks[:3], pks[3:6], pks[6:], pks[3:6], pks[:3]],
+        )
+        self.assertEqual(self.pages(7), [pks])
+
+    def test_values(self):
+        qs = SomeModel.objects.values('pk', 'int_field')
+        rows, previous, next = window(qs, size=2)
+        self.assertEqual(
+            rows,
+            [
+                {'pk': self.pks[0], 'int_field': 0},
+                {'pk': self.pks[1], 'int_field': 1},
+            ],
+        )
+        self.assertEqual(
+            decode_cursor(next, SomeModel), ('after', self.pks[1])
+        )
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            window(SomeModel.objects.all(), 'garbage')
+
+    def test_uuid_pk(self):
+        pks = sorted(SomeUUIDModel.objects.create().pk for i in range(3))
+        qs = SomeUUIDModel.objects.all()
+        rows, previous, next = window(qs, size=2)
+        self.assertEqual(decode_cursor(next, SomeUUIDModel), ('after', pks[1]))
+        rows, previous, next = window(qs, next, 2)
+        self.assertEqual([row.pk for row in rows], pks[2:])
+        rows, previous, next = window(qs, previous, 2)
+        self.assertEqual([row.pk for row in rows], pks[:2])
+
+    def test_deep_page_query(self):
+        qs = SomeModel.objects.all()
+        rows, previous, next = window(qs, size=5)
+        with self.assertNumQueries(1) as queries:
+            window(qs, next, 5)
+        self.assertNotIn('OFFSET', queries.captured_queries[0]['sql'])
+
+    def test_estimate_count(self):
+        qs = SomeModel.objects.all()
+        self.assertEqual(estimate_count(qs, limit=10), (7, True))
+        self.assertEqual(estimate_count(qs, limit=5), (5, False))
+
+
+def timing_out():
+    """Makes all the sandboxed statements time out."""
+    return mock.patch.multiple(
+        SQLiteStatementLimit,
+        PROGRESS_STEPS=1,
+        start=lambda self: setattr(self, 'deadline', 0),
+    )
+
+
+class SandboxTestCase(TestCase):
+    INFINITE = (
+        'WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r) '
+        'SELECT count(*) FROM r'
+    )
+
+    def test_read_only(self):
+        SomeModel.objects.create(text_field='foo', int_field=1)
+        with sandboxed_queries():
+            self.assertEqual(SomeModel.objects.count(), 1)
+        with self.assertRaises(DatabaseError):
+            with sandboxed_queries():
+                SomeModel.objects.create(text_field='bar', int_field=2)
+        self.assertEqual(SomeModel.objects.count(), 1)
+        # writes are allowed again after the block
+        SomeModel.objects.create(text_field='bar', int_field=2)
+
+    def test_read_only_within_transactions(self):
+        connection = mock.MagicMock()
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (0,)
+
+        limit = PostgreSQLStatementLimit(connection, 10, outermost=False)
+        limit.enter()
+        self.assertTrue(limit.read_only)
+        cursor.execute.assert_any_call('SET LOCAL transaction_read_only = on')
+
+        # MySQL transactions cannot be made read-only once started
+        limit = MySQLStatementLimit(connection, 10, outermost=False)
+        limit.enter()
+        self.assertFalse(limit.read_only)
+        limit = MySQLStatementLimit(connection, 10, outermost=True)
+        limit.enter()
+        self.assertTrue(limit.read_only)
+        cursor.execute.assert_any_call('SET TRANSACTION READ ONLY')
+
+    def test_timeout(self):
+        timeouts = []
+
+        def receiver(sql, timeout, **kwargs):
+            timeouts.append((sql, timeout))
+
+        query_timed_out.connect(receiver)
+        try:
+            with self.assertLogs('massmailer.utils.db', 'WARNING'):
+                with self.assertRaises(QueryTimeout) as cm:
+                    with sandboxed_queries(timeout=0.1):
+                        with connection.cursor() as cursor:
+                            cursor.execute(self.INFINITE)
+        finally:
+            query_timed_out.disconnect(receiver)
+        self.assertEqual(cm.exception.timeout, 0.1)
+        self.assertEqual(timeouts, [(self.INFINITE, 0.1)])
+        # the connection is still usable
+        self.assertEqual(SomeModel.objects.count(), 0)
+
+
+class SerializerTestCase(TestCase):
+    def test_alias_relations(self):
+        parent = SomeModel.objects.create(text_field='foo', int_field=1)
+        child = SomeChild.objects.create(parent=parent, child_field='bar')
+        serializer = Serializer(
+            SomeChild,
+            'child',
+            [('parent', 'parent'), ('text', 'parent__text_field')],
+        )
+        with self.assertNumQueries(1):
+            (row,) = serializer.values(SomeChild.objects.all())
+        result = serializer.serialize(row)
+        self.assertEqual(set(result), {'child', 'parent'})
+        self.assertEqual(result['child']['pk'], child.pk)
+        self.assertEqual(result['child']['fields']['child_field'], 'bar')
+        self.assertEqual(result['parent']['pk'], parent.pk)
+        self.assertEqual(result['parent']['fields']['text_field'], 'foo')
+
+    def test_many_to_many(self):
+        User = get_user_model()
+        staff = Group.objects.create(name='staff')
+        admins = Group.objects.create(name='admins')
+        alice = User.objects.create_user('alice')
+        alice.groups.set([staff, admins])
+        bob = User.objects.create_user('bob')
+        serializer = Serializer(User, 'user', [])
+        self.assertNotIn('groups', serializer.columns())
+        rows = list(serializer.values(User.objects.order_by('pk')))
+        # one query per many-to-many field, for all the rows
+        with self.assertNumQueries(2):
+            results = serializer.serialize_rows(rows)
+        alice_fields = results[0]['user']['fields']
+        self.assertEqual(alice_fields['username'], 'alice')
+        self.assertEqual(alice_fields['groups'], sorted([staff.pk, admins.pk]))
+        self.assertEqual(alice_fields['user_permissions'], [])
+        self.assertEqual(results[1]['user']['pk'], bob.pk)
+        self.assertEqual(results[1]['user']['fields']['groups'], [])
+        self.assertEqual(serializer.serialize(rows[0]), results[0])
+
+
+class PreviewViewTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.user = User.objects.create_superuser(
+            'admin', 'admin@example.org', 'password'
+        )
+        for i in range(4):
+            User.objects.create_user(
+                'user{}'.format(i), email='user{}@example.org'.format(i)
+            )
+        self.factory = RequestFactory()
+
+    def post(self, view, data):
+        request = self.factory.post('/', data)
+        request.user = self.user
+        return json.loads(view.as_view()(request).content)
+
+    def test_query_preview(self):
+        query = "User .username starts with 'user'"
+        data = self.post(QueryPreviewView, {'query': query, 'size': 3})
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(data['user_count'], 4)
+        self.assertIsNone(data['previous'])
+        self.assertEqual(
+            [r['user']['fields']['username'] for r in data['results']],
+            ['user0', 'user1', 'user2'],
+        )
+        self.assertNotIn('id', data['results'][0]['user']['fields'])
+
+        data = self.post(
+            QueryPreviewView,
+            {'query': query, 'size': 3, 'cursor': data['next']},
+        )
+        self.assertEqual(
+            [r['user']['fields']['username'] for r in data['results']],
+            ['user3'],
+        )
+        self.assertIsNone(data['next'])
+        self.assertIsNotNone(data['previous'])
+
+        data = self.post(
+            QueryPreviewView, {'query': query, 'cursor': 'garbage'}
+        )
+        self.assertIn('error', data)
+
+    def test_template_preview(self):
+        template = Template.objects.create(
+            name="Hello",
+            language="en-US",
+            subject="Hello {{ user.username }}",
+            plain_body="Hi!",
+        )
+        query = Query.objects.create(
+            name="Users", query="User .username starts with 'user'"
+        )
+        data = {
+            'query': query.pk,
+            'language': template.language,
+            'subject': template.subject,
+            'plain': template.plain_body,
+        }
+        result = self.post(TemplatePreviewView, data)
+        self.assertEqual(result['query']['count'], 4)
+        self.assertEqual(result['render']['subject']['content'], 'Hello user0')
+
+        data['cursor'] = result['query']['next']
+        result = self.post(TemplatePreviewView, data)
+        self.assertEqual(result['render']['subject']['content'], 'Hello user1')
+
+    def test_template_preview_timeout(self):
+        query = Query.objects.create(name="Users", query="User")
+        data = {
+            'query': query.pk,
+            'language': 'en-US',
+            'subject': "{{ user.groups.count() }}",
+            'plain': "Hi!",
+        }
+        render = Template.full_preview
+
+        def full_preview(self, context):
+            with mock.patch.object(
+                SQLiteStatementLimit,
+                'start',
+                lambda self: setattr(self, 'deadline', 0),
+            ):
+                return render(self, context)
+
+        # the queries made by the template are limited too
+        with mock.patch.object(SQLiteStatementLimit, 'PROGRESS_STEPS', 1):
+            with mock.patch.object(Template, 'full_preview', full_preview):
+                with self.assertLogs('massmailer.utils.db'):
+                    result = self.post(TemplatePreviewView, data)
+        self.assertEqual(
+            result['error'], "The query was cancelled after 10 seconds."
+        )
+
+    def test_estimated_counts(self):
+        query = "User .username starts with 'user'"
+        conf = celery.current_app.conf
+        saved = conf.task_always_eager, conf.task_eager_propagates
+        conf.task_always_eager = conf.task_eager_propagates = True
+        try:
+            with mock.patch('massmailer.views.COUNT_ESTIMATE_LIMIT', 2):
+                data = self.post(QueryPreviewView, {'query': query})
+        finally:
+            conf.task_always_eager, conf.task_eager_propagates = saved
+        self.assertTrue(data['approximate'])
+        self.assertEqual(data['count'], 2)
+        # counted exactly by the background task
+        counts = self.post(QueryCountView, {'query': query})
+        self.assertEqual(counts, {'count': 4, 'user_count': 4})
+        data = self.post(QueryPreviewView, {'query': query})
+        self.assertFalse(data['approximate'])
+        self.assertEqual(data['count'], 4)
+
+    def test_query_timeout(self):
+        query = "User .username starts with 'user'"
+        with timing_out(), self.assertLogs('massmailer.utils.db'):
+            data = self.post(QueryPreviewView, {'query': query})
+        self.assertEqual(
+            data, {'error': "The query was cancelled after 10 seconds."}
+        )
+
+    def test_background_count_timeout(self):
+        with mock.patch(
+            'massmailer.models.sandboxed_queries', wraps=sandboxed_queries
+        ) as sandbox:
+            count_query("User")
+        sandbox.assert_called_with(60)
+        counts = self.post(QueryCountView, {'query': "User"})
+        self.assertEqual(counts, {'count': 5, 'user_count': 5})
+
+        # timed out counts are not queued again for a while
+        query = "User .username starts with 'user'"
+        with timing_out(), self.assertLogs('massmailer.utils.db'):
+            with self.assertRaises(QueryTimeout):
+                count_query(query)
+        with mock.patch('massmailer.tasks.count_query.delay') as delay:
+            count_query_later(query)
+        delay.assert_not_called()
+
+    def test_count_view_unknown_query(self):
+        counts = self.post(QueryCountView, {'query': "User"})
+        self.assertEqual(counts, {'count': None, 'user_count': None})
@@ -1,8 +1,17 @@
+import concurrent.futures
 import unittest
 
 from django.test import TestCase
 
-from massmailer.query_parser import QueryParser, ParseError
+from massmailer.models import Query
+from massmailer.query_parser import (
+    PARSED_QUERIES,
+    QueryParser,
+    ParseError,
+    default_registries,
+    normalize,
+)
+from tests.models import SomeModel
 
 
 class QueryParserTestCase(TestCase):
@@ -304,3 +313,155 @@ class QueryParserTestCase(TestCase):
             ParseError, r"SomeEnum.+no member.+garbage"
         ):
             qp.parse_query("SomeModel .text_field = MyApp.SomeEnum.garbage")
+
+    def test_concurrent_parses(self):
+        from tests.models import SomeModel, SomeChild
+
+        parsers = []
+        for model in (SomeModel, SomeChild):
+            qp = QueryParser(load_django_funcs=False, load_django_models=False)
+            qp.available_models['Thing'] = model
+            parsers.append((qp, model))
+
+        def parse(i):
+            qp, model = parsers[i % 2]
+            return qp.parse_query("Thing as thing").queryset.model, model
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            for parsed, expected in pool.map(parse, range(200)):
+                self.assertIs(parsed, expected)
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("# c\nSomeModel  # d\n\t.a = 'x # y  z'\n"),
+            "SomeModel .a = 'x # y  z'",
+        )
+
+    def test_query_comments_anywhere(self):
+        qp = QueryParser(load_django_funcs=False)
+        r = qp.parse_query(
+            "SomeModel .text_field # the field\n= 'foo' # the value\n"
+            ".other_text does # really\n not contain 'qux'"
+        )
+        self.assertEqual(r.queryset.count(), 1)
+
+    def test_parse_cache(self):
+        qp = QueryParser(load_django_funcs=False)
+        PARSED_QUERIES.clear()
+        r1 = qp.parse_query(
+            "SomeModel .int_field > 10 alias text = .text_field"
+        )
+        r2 = qp.parse_query(
+            "# same query\nSomeModel\n  .int_field > 10\n"
+            "alias text = .text_field"
+        )
+        self.assertEqual(PARSED_QUERIES.info()['hits'], 1)
+        self.assertIsNot(r1.queryset, r2.queryset)
+        self.assertIsNot(r1.aliases, r2.aliases)
+        r1.aliases['email'] = 'email'
+        self.assertEqual(r2.aliases, {'text': 'text_field'})
+        self.assertEqual(r2.queryset.count(), 2)
+
+    def test_parse_cache_registries(self):
+        from tests.models import SomeModel, SomeChild
+
+        qp = QueryParser(load_django_funcs=False, load_django_models=False)
+        qp.available_models['Thing'] = SomeModel
+        self.assertIs(qp.parse_query("Thing").queryset.model, SomeModel)
+        qp.available_models['Thing'] = SomeChild
+        self.assertIs(qp.parse_query("Thing").queryset.model, SomeChild)
+
+    def test_default_registries(self):
+        from massmailer import REGISTERED_ENUMS, register_enum
+        from tests.models import SomeEnum, SomeModel
+
+        registries = default_registries()
+        self.assertIs(default_registries(), registries)
+        self.assertIs(registries.models['SomeModel'], SomeModel)
+        with self.assertRaises(TypeError):
+            registries.models['Other'] = SomeModel
+
+        register_enum('Test', 'Registered')(SomeEnum)
+        try:
+            updated = default_registries()
+            self.assertEqual(updated.version, registries.version + 1)
+            self.assertIs(updated.enums['Test.Registered'], SomeEnum)
+            qp = QueryParser(load_django_funcs=False)
+            r = qp.parse_query("SomeModel .int_field = Test.Registered.foo")
+            self.assertEqual(r.queryset.count(), 1)
+        finally:
+            del REGISTERED_ENUMS['Test.Registered']
+
+    def test_funcs_defined_later(self):
+        from django.db import models
+
+        registries = default_registries()
+        with self.assertRaisesRegex(ParseError, 'Unknown function'):
+            QueryParser().parse_query("SomeModel twice(.int_field) = 84")
+
+        class Twice(models.Func):
+            template = '(%(expressions)s * 2)'
+
+        qp = QueryParser()
+        r = qp.parse_query("SomeModel twice(.int_field) = 84")
+        self.assertEqual(r.queryset.count(), 1)
+        self.assertEqual(default_registries().version, registries.version + 1)
+        self.assertIs(default_registries().funcs['twice'], Twice)
+        with self.assertRaisesRegex(ParseError, 'Unknown function'):
+            QueryParser(load_django_funcs=False).parse_query(
+                "SomeModel twice(.int_field) = 84"
+            )
+
+    def test_parser_registries_are_not_shared(self):
+        from tests.models import SomeModel
+
+        qp = QueryParser(load_django_funcs=False)
+        qp.available_models['Thing'] = SomeModel
+        self.assertNotIn('Thing', QueryParser().available_models)
+        self.assertNotIn('Thing', default_registries().models)
+        with self.assertRaisesRegex(ParseError, 'Unknown.+model.+Thing'):
+            QueryParser().parse_query("Thing")
+
+
+class QueryExecuteTestCase(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import Group, User
+
+        self.users = [
+            User.objects.create(username=name, email=name + '@example.org')
+            for name in ('alice', 'bob', 'carol')
+        ]
+        group = Group.objects.create(name='group')
+        group.user_set.add(*self.users[:2])
+        Group.objects.create(name='empty')
+
+    def test_execute_user_query(self):
+        with self.assertNumQueries(1):
+            result, user_qs = Query.execute("User .username != 'carol'")
+        self.assertEqual(result.aliases, {'email': 'email'})
+        self.assertIs(user_qs, result.queryset)
+
+    def test_execute_empty(self):
+        with self.assertRaisesRegex(ParseError, 'non empty'):
+            Query.execute("User .username = 'nobody'")
+
+    def test_execute_no_email(self):
+        SomeModel.objects.create(text_field='foo', int_field=1)
+        with self.assertRaisesRegex(ParseError, 'email'):
+            Query.execute("SomeModel")
+
+    def test_execute_user_alias(self):
+        with self.assertNumQueries(1):
+            result, user_qs = Query.execute(
+                "Group alias user = .user alias email = .user.email"
+            )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                sorted(u.username for u in user_qs), ['alice', 'bob']
+            )
+
+    def test_execute_user_alias_errors(self):
+        with self.assertRaisesRegex(ParseError, 'auth.Group.permissions'):
+            Query.execute("Group alias user = .permissions")
+        with self.assertRaisesRegex(ParseError, 'no field `garbage`'):
+            Query.execute("Group alias user = .garbage")
@@ -4,8 +4,27 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.auth',
     'django.contrib.sessions',
+    'crispy_forms',
+    'django_bootstrap_breadcrumbs',
+    'reversion',
     'tests',
     'massmailer',
 ]
 
 DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3'}}
+
+ROOT_URLCONF = 'tests.urls'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request'
+            ]
+        },
+    }
+]
+
+STATIC_URL = '/static/'
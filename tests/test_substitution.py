@@ -0,0 +1,96 @@
+import jinja2
+
+from django.test import SimpleTestCase
+
+from massmailer.models import Template, TemplateItem
+from massmailer.utils.substitution import (
+    SubstitutionTemplate,
+    compile_substitutions,
+)
+
+
+class User:
+    first_name = "Ada"
+    _secret = "hidden"
+    html = "<b>&</b>"
+
+    def get_full_name(self):
+        return "Ada Lovelace"
+
+
+CONTEXT = {
+    'user': User(),
+    'data': {'key': 'value', 'markup': jinja2.Markup('<i>ok</i>')},
+    'number': 42,
+    'nothing': None,
+}
+
+SOURCES = [
+    "Hello {{ user.first_name }}!",
+    "{{ user.html }} {{ data.markup }} {{ number }} {{ nothing }}",
+    "{{ data.key }}\n\nBye\n",
+    "{{ user.get_full_name }}",
+    "{{ range }}",
+    "plain text only",
+    "",
+    "{{ user.missing }}",
+    "{{ missing }}",
+    "{{ missing.attr }}",
+    "{{ user._secret }}",
+    "{{ user.__class__ }}",
+    "{{ nothing.attr }}",
+]
+
+
+class SubstitutionTestCase(SimpleTestCase):
+    def render(self, renderer):
+        try:
+            return renderer.render(dict(CONTEXT))
+        except Exception as error:
+            return type(error), str(error)
+
+    def test_same_output_as_jinja(self):
+        for item in (TemplateItem.subject, TemplateItem.html):
+            env = Template.environment(item)
+            for source in SOURCES:
+                with self.subTest(item=item, source=source):
+                    ast = env.parse(source)
+                    fast = compile_substitutions(env, ast)
+                    self.assertIsInstance(fast, SubstitutionTemplate)
+                    self.assertEqual(
+                        self.render(fast),
+                        self.render(env.from_string(source)),
+                    )
+
+    def test_fallback(self):
+        env = Template.environment(TemplateItem.plain)
+        for source in [
+            "{{ user.get_full_name() }}",
+            "{{ data['key'] }}",
+            "{{ user.first_name|upper }}",
+            "{% if user %}yes{% endif %}",
+            "{{ 'constant' }}",
+            "{# comment #}{% set a = 1 %}{{ a }}",
+        ]:
+            with self.subTest(source=source):
+                ast = env.parse(source)
+                self.assertIsNone(compile_substitutions(env, ast))
+
+    def test_template_render(self):
+        t = Template(
+            language='en-US',
+            subject="Hi {{ user.first_name }}",
+            plain_body="{{ user.get_full_name() }}",
+        )
+        self.assertIsInstance(
+            t.compiled(TemplateItem.subject).renderer, SubstitutionTemplate
+        )
+        self.assertIsInstance(
+            t.compiled(TemplateItem.plain).renderer, jinja2.Template
+        )
+        self.assertEqual(
+            t.render(TemplateItem.subject, {'user': User()}), "Hi Ada"
+        )
+        self.assertEqual(
+            t.render(TemplateItem.plain, {'user': User()}), "Ada Lovelace"
+        )
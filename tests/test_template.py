@@ -1,9 +1,26 @@
 import datetime
+import decimal
+import jinja2.sandbox
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 
-from massmailer.models import Template, TemplateItem
+from massmailer import REGISTERED_FILTERS, register_filter
+from massmailer.models import (
+    COMPILED_TEMPLATES,
+    ENVIRONMENTS,
+    Template,
+    TemplateItem,
+)
+from massmailer.utils import (
+    MARKDOWN_CONVERSIONS,
+    bytecode,
+    filters,
+    markdown_to_html,
+)
+from massmailer.utils.cache import LRUCache
+from massmailer.utils.sandbox import SandboxedModelEnvironment
 
 
 def create_simple_template():
@@ -158,3 +175,241 @@ class TemplateTestCase(TestCase):
             'is not safely callable',
             result['plain']['error']['msg'],
         )
+
+    def test_sandbox_decisions_cached(self):
+        env = SandboxedModelEnvironment()
+        template = env.from_string(
+            "{{ user.get_username() }} {{ user.__class__ }}"
+        )
+        users = get_user_model().objects.all()
+        for user in users:
+            template.render(user=user)
+        self.assertIn((get_user_model(), 'get_username'), env.safe_attributes)
+        self.assertFalse(env.safe_attributes[(get_user_model(), '__class__')])
+        self.assertEqual(len(env.safe_callables), 1)
+
+        template = env.from_string("{{ user.delete() }}")
+        with self.assertRaises(jinja2.sandbox.SecurityError):
+            template.render(user=users[0])
+
+    def test_compiled_per_environment(self):
+        t = create_simple_template()
+        template = t.template(TemplateItem.plain)
+        self.assertIsInstance(template.environment, SandboxedModelEnvironment)
+        with mock.patch.dict(REGISTERED_FILTERS):
+            register_filter('shout')(str.upper)
+            other = t.template(TemplateItem.plain)
+            self.assertIsNot(other.environment, template.environment)
+            self.assertIsNot(other, template)
+        self.assertIs(t.template(TemplateItem.plain), template)
+
+    def test_template_environment_shared(self):
+        t = create_simple_template()
+        other = create_html_template()
+        self.assertIs(
+            t.environment(TemplateItem.subject),
+            other.environment(TemplateItem.plain),
+        )
+        self.assertIsNot(
+            t.environment(TemplateItem.plain),
+            t.environment(TemplateItem.html),
+        )
+        self.assertTrue(t.environment(TemplateItem.html).autoescape)
+        self.assertFalse(t.environment(TemplateItem.subject).autoescape)
+
+    def test_template_compiled_once(self):
+        COMPILED_TEMPLATES.clear()
+        t = create_simple_template()
+        for _ in range(3):
+            t.render(TemplateItem.subject, self.template_context)
+        self.assertEqual(COMPILED_TEMPLATES.misses, 1)
+        self.assertEqual(COMPILED_TEMPLATES.hits, 2)
+        self.assertIs(
+            t.template(TemplateItem.subject),
+            t.template(TemplateItem.subject),
+        )
+
+    def test_template_full_preview_parsed_once(self):
+        t = Template(
+            language='en-US',
+            subject="Preview {{ user }}",
+            plain_body="Parsed once, {{ user }}",
+            html_body="<p>Parsed once, {{ user }}</p>",
+        )
+        with mock.patch.object(
+            SandboxedModelEnvironment,
+            'parse',
+            autospec=True,
+            side_effect=SandboxedModelEnvironment.parse,
+        ) as mock_parse:
+            for i in range(3):
+                preview = t.full_preview({'user': 'toto'})
+                t.preview(TemplateItem.plain)
+        self.assertEqual(preview['plain']['content'], "Parsed once, toto")
+        self.assertEqual(mock_parse.call_count, 3)
+
+    def test_template_cache_invalidated_on_save(self):
+        t = create_simple_template()
+        t.render(TemplateItem.subject, self.template_context)
+        t.subject = "Bye {{ user.username }}"
+        t.save()
+        self.assertFalse(
+            any(key[0] == t.pk for key in COMPILED_TEMPLATES._data)
+        )
+        self.assertEqual(
+            t.render(TemplateItem.subject, self.template_context),
+            "Bye zopieux",
+        )
+
+
+class FilterTestCase(TestCase):
+    def test_locale_parsed_once(self):
+        filters.parse_locale.cache_clear()
+        t = create_simple_baguette_template()
+        for day in range(1, 4):
+            t.render(
+                TemplateItem.plain,
+                {
+                    'user': {'username': 'toto'},
+                    'today': datetime.date(2019, 12, day),
+                },
+            )
+        self.assertEqual(filters.parse_locale.cache_info().misses, 1)
+
+    def test_registered_pure_filter_memoized(self):
+        calls = []
+
+        with mock.patch.dict(REGISTERED_FILTERS):
+
+            @register_filter('shout', pure=True)
+            def shout(value, suffix='!'):
+                calls.append(value)
+                return value.upper() + suffix
+
+            t = Template(
+                language='en-US',
+                subject='{{ name|shout }} {{ name|shout("?") }}',
+            )
+            memo = LRUCache()
+            for i in range(3):
+                with filters.memoize(memo):
+                    subject = t.render(TemplateItem.subject, {'name': 'a'})
+                self.assertEqual(subject, 'A! A?')
+            self.assertListEqual(calls, ['a', 'a'])
+
+            # no memo outside of memoize()
+            t.render(TemplateItem.subject, {'name': 'a'})
+            self.assertEqual(len(calls), 4)
+
+    def test_memo_distinguishes_equal_values(self):
+        utc = datetime.datetime(2019, 12, 1, 12, tzinfo=datetime.timezone.utc)
+        paris = utc.astimezone(datetime.timezone(datetime.timedelta(hours=2)))
+        with mock.patch.dict(REGISTERED_FILTERS):
+            register_filter('show', pure=True)(str)
+            t = Template(
+                language='en-US',
+                subject="{{ date|format_time('HH:mm ZZZZ') }} "
+                "{{ value|show }}",
+            )
+            memo = LRUCache()
+            subjects = []
+            for date, value in (
+                (utc, decimal.Decimal('1.0')),
+                (paris, decimal.Decimal('1.00')),
+                (utc, True),
+                (utc, 1),
+            ):
+                with filters.memoize(memo):
+                    subjects.append(
+                        t.render(
+                            TemplateItem.subject,
+                            {'date': date, 'value': value},
+                        )
+                    )
+        self.assertListEqual(
+            subjects,
+            [
+                '12:00 GMT+00:00 1.0',
+                '14:00 GMT+02:00 1.00',
+                '12:00 GMT+00:00 True',
+                '12:00 GMT+00:00 1',
+            ],
+        )
+
+
+class MarkdownTestCase(TestCase):
+    def test_jinja_tags_kept(self):
+        html = markdown_to_html(
+            "# Hi {{ user.username }}\n\n"
+            "*{% if user.is_staff %}staff{% endif %}* {{ a_b_c }}"
+        )
+        self.assertEqual(
+            html,
+            "<h1>Hi {{ user.username }}</h1>\n<p><em>"
+            "{% if user.is_staff %}staff{% endif %}</em> {{ a_b_c }}</p>",
+        )
+
+    def test_many_tags(self):
+        source = '\n\n'.join('{{{{ v{} }}}}'.format(i) for i in range(500))
+        html = markdown_to_html(source)
+        self.assertEqual(html.count('{{'), 500)
+        self.assertIn('<p>{{ v499 }}</p>', html)
+
+    def test_conversions_cached(self):
+        MARKDOWN_CONVERSIONS.clear()
+        markdown_to_html("*Hi* {{ user.username }}")
+        markdown_to_html("*Hi* {{ user.username }}")
+        self.assertEqual(MARKDOWN_CONVERSIONS.hits, 1)
+
+
+class BytecodeCacheTestCase(TestCase):
+    def test_compiled_code_shared(self):
+        bcc = bytecode.DjangoCacheBytecodeCache()
+        source = "Hi {{ name }}"
+        name = bytecode.template_name('test', source)
+        env = SandboxedModelEnvironment(bytecode_cache=bcc)
+        bytecode.compile_template(env, source, name)
+
+        other = SandboxedModelEnvironment(bytecode_cache=bcc)
+        with mock.patch.object(other, 'compile', side_effect=AssertionError):
+            template = bytecode.compile_template(other, source, name)
+        self.assertEqual(template.render(name="you"), "Hi you")
+
+    def test_reset_on_setting_changed(self):
+        t = create_simple_template()
+        template = t.template(TemplateItem.subject)
+        self.assertIsNone(template.environment.bytecode_cache)
+        with override_settings(
+            MASSMAILER_BYTECODE_CACHE={
+                'BACKEND': 'massmailer.utils.bytecode.DjangoCacheBytecodeCache'
+            }
+        ):
+            cached = t.template(TemplateItem.subject)
+            self.assertIsInstance(
+                cached.environment.bytecode_cache,
+                bytecode.DjangoCacheBytecodeCache,
+            )
+        self.assertIsNone(bytecode.get_cache())
+        template = t.template(TemplateItem.subject)
+        self.assertIsNone(template.environment.bytecode_cache)
+
+    @override_settings(
+        MASSMAILER_BYTECODE_CACHE={
+            'BACKEND': 'massmailer.utils.bytecode.DjangoCacheBytecodeCache'
+        }
+    )
+    def test_stale_entries_pruned_on_save(self):
+        COMPILED_TEMPLATES.clear()
+        with mock.patch.dict(ENVIRONMENTS, clear=True), mock.patch.object(
+            bytecode, '_cache', None
+        ):
+            t = create_simple_template()
+            t.template(TemplateItem.subject)
+            bcc = bytecode.get_cache()
+            name = t.bytecode_name(TemplateItem.subject, t.subject)
+            key = bcc.prefix + bcc.get_cache_key(name)
+            self.assertIsNotNone(bcc.cache.get(key))
+
+            t.subject = "Changed"
+            t.save()
+            self.assertIsNone(bcc.cache.get(key))
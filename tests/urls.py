@@ -0,0 +1,3 @@
+from django.urls import include, path
+
+urlpatterns = [path('mailing/', include('massmailer.urls'))]